@@ -0,0 +1,228 @@
+"""Headless JSON API for POS terminals and scanners.
+
+Run with `python api.py --port 8502`. Every request needs an `Authorization: Bearer <token>`
+header; issue tokens with `python manage.py create-api-token <username>`.
+
+    GET  /api/products?q=&barcode=&limit=     stock lookup (served from a short-lived cache)
+    GET  /api/products/<id>
+    POST /api/sales                           {"items": [{"product_id", "qty", "price"?}]}
+    POST /api/sales/batch                     {"sales": [{"items": [...]}, ...]} in one transaction
+    POST /api/debts/<customer|supplier>/<id>/payments   {"amount", "payment_method"?}
+"""
+import argparse
+import json
+import math
+import sqlite3
+import threading
+import time
+import tornado.ioloop
+import tornado.web
+from database import RestoreInProgress, connect, init_db, record_debt_payment, record_sales, resolve_api_token
+from lookups import invalidate_lookups
+
+STOCK_CACHE_TTL = 2.0   # seconds a tenant's stock snapshot is served before reloading
+TOKEN_CACHE_TTL = 60.0  # seconds a resolved token is trusted for reads
+TOKEN_WRITE_TTL = 2.0   # seconds a resolved token is trusted for writes, so a revoked token stops writing quickly
+MAX_BATCH_SALES = 1000  # sales accepted in one batch request
+PRICE_LOOKUP_CHUNK = 500  # product ids per price query, well under SQLite's bound-parameter limit
+
+_stock_cache = {}
+_stock_lock = threading.Lock()
+_token_cache = {}
+
+def get_stock(user_id):
+    """Return {product_id: product dict} for a tenant, reloading at most every STOCK_CACHE_TTL seconds."""
+    with _stock_lock:
+        entry = _stock_cache.get(user_id)
+    if entry is None or time.monotonic() - entry[0] > STOCK_CACHE_TTL:
+        with connect(user_id) as conn:
+            rows = conn.execute('''
+            SELECT id, name, category, quantity, unit_price, barcode FROM products WHERE user_id = ?
+            ''', (user_id,)).fetchall()
+        products = {row[0]: {'id': row[0], 'name': row[1], 'category': row[2], 'quantity': row[3],
+                             'unit_price': row[4], 'barcode': row[5]} for row in rows}
+        entry = (time.monotonic(), products)
+        with _stock_lock:
+            _stock_cache[user_id] = entry
+    return entry[1]
+
+def apply_sold(user_id, sales, results):
+    """Take recorded sales off the cached stock in place, so a write does not force a catalog reload."""
+    with _stock_lock:
+        entry = _stock_cache.get(user_id)
+        if entry is None:
+            return
+        for items, result in zip(sales, results):
+            if not result['ok'] or result.get('duplicate'):
+                continue
+            for item in items:
+                product = entry[1].get(item['product_id'])
+                if product is not None:
+                    product['quantity'] -= item['qty']
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def parse_sale(payload):
+    """Validate a sale body ({"items": [...]}) and return its items; raises HTTPError(400) on bad input."""
+    if not isinstance(payload, dict) or not isinstance(payload.get('items'), list) or not payload['items']:
+        raise tornado.web.HTTPError(400, reason="A sale needs a non-empty items list")
+    items = []
+    for item in payload['items']:
+        if not isinstance(item, dict):
+            raise tornado.web.HTTPError(400, reason="Each item must be an object")
+        product_id, qty, price = item.get('product_id'), item.get('qty'), item.get('price')
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            raise tornado.web.HTTPError(400, reason="product_id must be an integer")
+        if not _is_number(qty) or qty != int(qty) or qty <= 0:
+            raise tornado.web.HTTPError(400, reason="qty must be a positive integer")
+        if price is not None and (not _is_number(price) or price < 0):
+            raise tornado.web.HTTPError(400, reason="price must be a non-negative number")
+        items.append({'product_id': product_id, 'qty': int(qty), 'price': price})
+    return items
+
+def fill_prices(user_id, sales):
+    """Fill in list prices for items without one, reading only the products those items name."""
+    product_ids = sorted({item['product_id'] for items in sales for item in items if item['price'] is None})
+    prices = {}
+    with connect(user_id) as conn:
+        for start in range(0, len(product_ids), PRICE_LOOKUP_CHUNK):
+            chunk = product_ids[start:start + PRICE_LOOKUP_CHUNK]
+            prices.update(conn.execute(
+                f"SELECT id, unit_price FROM products WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})",
+                [user_id, *chunk]).fetchall())
+    for items in sales:
+        for item in items:
+            if item['price'] is None:
+                item['price'] = prices.get(item['product_id']) or 0
+    return sales
+
+class BaseHandler(tornado.web.RequestHandler):
+    async def prepare(self):
+        header = self.request.headers.get("Authorization", "")
+        token = header[len("Bearer "):] if header.startswith("Bearer ") else ""
+        # Reads may use a token resolved in the last minute; writes only one checked moments ago
+        ttl = TOKEN_CACHE_TTL if self.request.method == "GET" else TOKEN_WRITE_TTL
+        cached = _token_cache.get(token)
+        if cached is not None and time.monotonic() - cached[0] <= ttl:
+            self.user_id = cached[1]
+        else:
+            self.user_id = await self.run_db(resolve_api_token, token) if token else None
+            if self.user_id is None:
+                _token_cache.pop(token, None)
+            else:
+                _token_cache[token] = (time.monotonic(), self.user_id)
+        if self.user_id is None:
+            raise tornado.web.HTTPError(401, reason="Invalid or missing API token")
+
+    def json_body(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Request body must be JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="Request body must be a JSON object")
+        return body
+
+    async def run_db(self, fn, *args):
+        """Run a blocking database call off the IO loop."""
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(None, fn, *args)
+        except RestoreInProgress as e:
+            raise tornado.web.HTTPError(503, reason=str(e))
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({'error': self._reason})
+
+class ProductsHandler(BaseHandler):
+    async def get(self):
+        stock = await self.run_db(get_stock, self.user_id)
+        query = self.get_argument("q", "").lower()
+        barcode = self.get_argument("barcode", None)
+        try:
+            limit = int(self.get_argument("limit", "50"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="limit must be an integer")
+        if limit < 1:
+            raise tornado.web.HTTPError(400, reason="limit must be at least 1")
+        matches = [product for product in stock.values()
+                   if (barcode is None or product['barcode'] == barcode)
+                   and (not query or query in (product['name'] or "").lower())]
+        self.write({'products': matches[:limit]})
+
+class ProductHandler(BaseHandler):
+    async def get(self, product_id):
+        stock = await self.run_db(get_stock, self.user_id)
+        product = stock.get(int(product_id))
+        if product is None:
+            raise tornado.web.HTTPError(404, reason="Product not found")
+        self.write(product)
+
+class SalesHandler(BaseHandler):
+    async def post(self):
+        sales = await self.run_db(fill_prices, self.user_id, [parse_sale(self.json_body())])
+        results = await self.run_db(record_sales, self.user_id, sales, "api")
+        apply_sold(self.user_id, sales, results)
+        result = results[0]
+        if not result['ok']:
+            self.set_status(409)
+        self.write(result)
+
+class SalesBatchHandler(BaseHandler):
+    async def post(self):
+        sales = self.json_body().get('sales')
+        if not isinstance(sales, list) or not 1 <= len(sales) <= MAX_BATCH_SALES:
+            raise tornado.web.HTTPError(400, reason=f"A batch needs a list of 1 to {MAX_BATCH_SALES} sales")
+        batch = []
+        for index, sale in enumerate(sales):
+            try:
+                batch.append(parse_sale(sale))
+            except tornado.web.HTTPError as e:
+                raise tornado.web.HTTPError(400, reason=f"Sale {index}: {e.reason}")
+        batch = await self.run_db(fill_prices, self.user_id, batch)
+        results = await self.run_db(record_sales, self.user_id, batch, "api")
+        apply_sold(self.user_id, batch, results)
+        self.write({'results': results, 'recorded': sum(result['ok'] for result in results)})
+
+class DebtPaymentHandler(BaseHandler):
+    async def post(self, kind, debt_id):
+        body = self.json_body()
+        try:
+            amount = float(body['amount'])
+        except (KeyError, TypeError, ValueError):
+            raise tornado.web.HTTPError(400, reason="amount is required")
+        if not amount > 0:
+            raise tornado.web.HTTPError(400, reason="amount must be positive")
+        if not isinstance(body.get('payment_method', "Cash"), str):
+            raise tornado.web.HTTPError(400, reason="payment_method must be a string")
+        try:
+            remaining = await self.run_db(record_debt_payment, self.user_id, kind, int(debt_id), amount,
+                                          body.get('payment_method', "Cash"))
+        except ValueError as e:
+            raise tornado.web.HTTPError(404, reason=str(e))
+        except sqlite3.IntegrityError as e:
+            raise tornado.web.HTTPError(409, reason=f"Payment rejected: {e}")
+        invalidate_lookups(self.user_id, f"{kind}_debts")
+        self.write({'debt_id': int(debt_id), 'remaining_amount': remaining})
+
+def make_app():
+    return tornado.web.Application([
+        (r"/api/products", ProductsHandler),
+        (r"/api/products/(\d+)", ProductHandler),
+        (r"/api/sales", SalesHandler),
+        (r"/api/sales/batch", SalesBatchHandler),
+        (r"/api/debts/(customer|supplier)/(\d+)/payments", DebtPaymentHandler),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description="RetailPulse POS API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    args = parser.parse_args()
+    init_db()
+    make_app().listen(args.port, address=args.host)
+    print(f"RetailPulse API listening on http://{args.host}:{args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,25 @@
 import streamlit as st
 import sqlite3
 import hashlib
-from database import DATABASE, log_history
+from database import assign_shard, connect, log_history
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def create_user(username, password, role="staff"):
-    with sqlite3.connect(DATABASE) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
         INSERT INTO users (username, password, role)
         VALUES (?, ?, ?)
         ''', (username, hash_password(password), role))
+        assign_shard(conn, cursor.lastrowid)
         conn.commit()
         # Log history for user creation
         log_history(None, "user", cursor.lastrowid, "create", f"Created user: {username}")
 
 def authenticate(username, password):
-    with sqlite3.connect(DATABASE) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
         SELECT id, username, role FROM users 
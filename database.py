@@ -1,13 +1,67 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import secrets
 import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from functools import wraps
 import pandas as pd
 import streamlit as st
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 DATABASE = "inventory.db"
+SCHEMA_VERSION = 8
+REQUIRED_TABLES = {
+    "users", "products", "sales", "customers", "customer_debts", "customer_debt_payments",
+    "suppliers", "supplier_debts", "supplier_debt_payments", "history",
+}
+RESTORE_CHUNK_SIZE = 4 * 1024 * 1024  # bytes streamed per read when spooling an upload
+RESTORE_PAGES_PER_STEP = 1024         # pages copied per backup step, for progress; the target stays write-locked throughout
+RESTORE_MARKER = DATABASE + ".restoring"  # present while a restore runs; gated writes fail fast instead of waiting
+RESTORE_MARKER_STALE = 60                 # seconds without a touch after which a marker is left over from a crash
+BACKUP_MEMBER = re.compile(r"^(inventory\.db|shards/shard_\d{4}\.db)$")  # files a backup zip may contain
+
+# Tenant sharding: users live in DATABASE, every tenant's rows live in a shard file recorded
+# on users.shard. Tenants without one still live in DATABASE until split_into_shards moves them.
+# TENANTS_PER_SHARD = 1 gives each shop its own file; larger values group shops together. It is
+# only used to place new tenants, so changing it never moves existing ones.
+SHARD_DIR = os.environ.get("RETAILPULSE_SHARD_DIR", "shards")
+TENANTS_PER_SHARD = int(os.environ.get("RETAILPULSE_TENANTS_PER_SHARD", "1"))
+POOL_SIZE = 8  # idle connections kept per shard
+TENANT_TABLES = [
+    "products", "sales", "customers", "customer_debts", "customer_debt_payments",
+    "suppliers", "supplier_debts", "supplier_debt_payments", "history",
+]
+
+BUSY_TIMEOUT = 30  # seconds a pooled connection waits on another writer's lock
+WRITE_BUSY_TIMEOUT = 1.0  # seconds per attempt inside retry_on_lock, so a held lock costs at most ~6 s in all
+LOCK_RETRY_ATTEMPTS = 5  # write transactions retried on "database is locked" before giving up
+
+# History retention: rows older than this are moved to history_archive.py's monthly files
+HISTORY_RETENTION_DAYS = int(os.environ.get("RETAILPULSE_HISTORY_RETENTION_DAYS", "90"))
+COUNTED_ACTIONS = {"view", "generate"}  # logged as daily counters instead of history rows
+
+_pools = {}
+_pools_lock = threading.Lock()
+_shard_names = {}  # user_id -> assigned shard file, cached once set (assignments never change)
+_lock_wait = threading.local()  # .timeout: busy timeout for connections borrowed inside retry_on_lock
 
 def init_db():
     with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
+        _create_tables(conn)
+
+def _create_tables(conn, include_users=True):
+    cursor = conn.cursor()
+    # Lets tenant purges hand freed pages back with incremental_vacuum; only applies to new files
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    previous_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if include_users:
         # Users Table (unchanged)
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -18,155 +72,1134 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )''')
         
-        # Products Table (unchanged)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            category TEXT,
-            quantity INTEGER CHECK(quantity >= 0),
-            unit_price REAL CHECK(unit_price >= 0),
-            barcode TEXT,
-            alert_threshold INTEGER DEFAULT 5,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_restock TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            UNIQUE(user_id, name)
-        )''')
-        
-        # Sales Table (unchanged)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sales (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            product_id INTEGER,
-            quantity_sold INTEGER CHECK(quantity_sold > 0),
-            total_price REAL CHECK(total_price >= 0),
-            sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (product_id) REFERENCES products (id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )''')
-        
-        # Customers Table (new)
+        # API Tokens (for POS terminals using api.py)
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            token_hash TEXT PRIMARY KEY,
             user_id INTEGER,
-            name TEXT,
-            phone TEXT,
-            address TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            label TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )''')
         
-        # Customer Debts Table (enhanced)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customer_debts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            customer_id INTEGER,
-            initial_amount REAL CHECK(initial_amount >= 0),
-            remaining_amount REAL CHECK(remaining_amount >= 0),
-            description TEXT,
-            due_date DATE,
-            status TEXT CHECK(status IN ('active', 'paid', 'overdue')),
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (customer_id) REFERENCES customers(id)
-        )''')
-        
-        # Customer Debt Payments Table (enhanced)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customer_debt_payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            debt_id INTEGER,
-            amount REAL CHECK(amount >= 0),
-            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            payment_method TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (debt_id) REFERENCES customer_debts(id)
-        )''')
-        
-        # Suppliers Table (enhanced)
+        # Tenant Purges (deleted users whose rows tenant_purge.py is still removing)
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS suppliers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            contact TEXT,
-            email TEXT,
-            address TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            UNIQUE(user_id, name)
+        CREATE TABLE IF NOT EXISTS tenant_purges (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rows_total INTEGER,
+            rows_deleted INTEGER DEFAULT 0,
+            finished_at TIMESTAMP
         )''')
         
-        # Supplier Debts Table (new)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS supplier_debts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            supplier_id INTEGER,
-            initial_amount REAL CHECK(initial_amount >= 0),
-            remaining_amount REAL CHECK(remaining_amount >= 0),
-            description TEXT,
-            due_date DATE,
-            status TEXT CHECK(status IN ('active', 'paid', 'overdue')),
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (supplier_id) REFERENCES suppliers(id)
-        )''')
-        
-        # Supplier Debt Payments Table (new)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS supplier_debt_payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            debt_id INTEGER,
-            amount REAL CHECK(amount >= 0),
-            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            payment_method TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (debt_id) REFERENCES supplier_debts(id)
-        )''')
-        
-        # History Table (new for tracking all changes)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            entity_type TEXT,  -- e.g., 'product', 'sale', 'customer_debt', 'supplier_debt'
-            entity_id INTEGER,
-            action TEXT,       -- e.g., 'create', 'update', 'delete', 'payment'
-            details TEXT,      -- JSON or text description of changes
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )''')
-        conn.commit()
+    # Products Table (unchanged)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        category TEXT,
+        quantity INTEGER CHECK(quantity >= 0),
+        unit_price REAL CHECK(unit_price >= 0),
+        barcode TEXT,
+        alert_threshold INTEGER DEFAULT 5,
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_restock TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        UNIQUE(user_id, name)
+    )''')
+    
+    # Sales Table (unchanged)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        product_id INTEGER,
+        quantity_sold INTEGER CHECK(quantity_sold > 0),
+        total_price REAL CHECK(total_price >= 0),
+        sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (product_id) REFERENCES products (id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    
+    # Customers Table (new)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        phone TEXT,
+        address TEXT,
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    
+    # Customer Debts Table (enhanced)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS customer_debts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        customer_id INTEGER,
+        initial_amount REAL CHECK(initial_amount >= 0),
+        remaining_amount REAL CHECK(remaining_amount >= 0),
+        description TEXT,
+        due_date DATE,
+        status TEXT CHECK(status IN ('active', 'paid', 'overdue')),
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (customer_id) REFERENCES customers(id)
+    )''')
+    
+    # Customer Debt Payments Table (enhanced)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS customer_debt_payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        debt_id INTEGER,
+        amount REAL CHECK(amount >= 0),
+        payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        payment_method TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (debt_id) REFERENCES customer_debts(id)
+    )''')
+    
+    # Suppliers Table (enhanced)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS suppliers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        contact TEXT,
+        email TEXT,
+        address TEXT,
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        UNIQUE(user_id, name)
+    )''')
+    
+    # Supplier Debts Table (new)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS supplier_debts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        supplier_id INTEGER,
+        initial_amount REAL CHECK(initial_amount >= 0),
+        remaining_amount REAL CHECK(remaining_amount >= 0),
+        description TEXT,
+        due_date DATE,
+        status TEXT CHECK(status IN ('active', 'paid', 'overdue')),
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (supplier_id) REFERENCES suppliers(id)
+    )''')
+    
+    # Supplier Debt Payments Table (new)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS supplier_debt_payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        debt_id INTEGER,
+        amount REAL CHECK(amount >= 0),
+        payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        payment_method TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (debt_id) REFERENCES supplier_debts(id)
+    )''')
+    
+    # History Table (new for tracking all changes)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        entity_type TEXT,  -- e.g., 'product', 'sale', 'customer_debt', 'supplier_debt'
+        entity_id INTEGER,
+        action TEXT,       -- e.g., 'create', 'update', 'delete', 'payment'
+        details TEXT,      -- JSON or text description of changes
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_time ON history (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_entity_time ON history (user_id, entity_type, timestamp)")
+    
+    # History Counters (daily counts of high-volume events such as page views)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS history_counters (
+        user_id INTEGER,
+        day DATE,
+        entity_type TEXT,
+        action TEXT,
+        detail TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, day, entity_type, action, detail)
+    )''')
+    
+    # Daily Sales Rollup (derived from sales, maintained incrementally by forecasting.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        user_id INTEGER,
+        product_id INTEGER,
+        day DATE,
+        quantity INTEGER,
+        PRIMARY KEY (user_id, product_id, day)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_day ON sales_daily (user_id, day)")
+    
+    # Demand Stats (per-product sums over the forecast windows, moved along one day at a time by forecasting.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS demand_stats (
+        user_id INTEGER,
+        product_id INTEGER,
+        total INTEGER DEFAULT 0,
+        total_sq INTEGER DEFAULT 0,
+        recent INTEGER DEFAULT 0,
+        first_day DATE,
+        weekday_0 INTEGER DEFAULT 0,
+        weekday_1 INTEGER DEFAULT 0,
+        weekday_2 INTEGER DEFAULT 0,
+        weekday_3 INTEGER DEFAULT 0,
+        weekday_4 INTEGER DEFAULT 0,
+        weekday_5 INTEGER DEFAULT 0,
+        weekday_6 INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, product_id)
+    )''')
+    
+    # Forecast State (rollup watermark per tenant, and the day demand_stats windows end on)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS forecast_state (
+        user_id INTEGER PRIMARY KEY,
+        last_sale_id INTEGER DEFAULT 0,
+        computed_date DATE,
+        stats_day DATE
+    )''')
+    _add_column(cursor, "forecast_state", "stats_day", "DATE")
+    
+    # Reorder Suggestions (latest forecast per product)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS reorder_suggestions (
+        user_id INTEGER,
+        product_id INTEGER,
+        daily_velocity REAL,
+        lead_time_demand REAL,
+        reorder_point INTEGER,
+        order_quantity INTEGER,
+        PRIMARY KEY (user_id, product_id)
+    )''')
+    
+    # Applied Sales (idempotency keys of sales replayed from the sale journal)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS applied_sales (
+        sale_key TEXT PRIMARY KEY,
+        user_id INTEGER,
+        sale_id INTEGER,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
+    # Counterparty Balances (kept current by triggers on debts and payments). Overdue amounts
+    # depend on today's date, so they are not stored here but summed from open debts when read.
+    if previous_version < 8:
+        for kind in ("customer", "supplier"):
+            for trigger in ("debts_balance_insert", "debts_balance_update", "debts_balance_delete",
+                            "debts_balance_move", "debt_payments_balance"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_{kind}_{trigger}")
+        cursor.execute("DROP TABLE IF EXISTS counterparty_balances")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS counterparty_balances (
+        user_id INTEGER,
+        counterparty_type TEXT CHECK(counterparty_type IN ('customer', 'supplier')),
+        counterparty_id INTEGER,
+        open_amount REAL DEFAULT 0,
+        open_debts INTEGER DEFAULT 0,
+        last_payment_date TIMESTAMP,
+        PRIMARY KEY (user_id, counterparty_type, counterparty_id)
+    )''')
+    for kind in ("customer", "supplier"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{kind}_debts_counterparty ON {kind}_debts (user_id, {kind}_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{kind}_debt_payments_debt ON {kind}_debt_payments (debt_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{kind}_debts_open_due ON {kind}_debts (user_id, due_date) WHERE status != 'paid'")
+        for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{kind}_debts_balance_{event.lower()}
+            AFTER {event} ON {kind}_debts
+            WHEN {ref}.{kind}_id IS NOT NULL
+            BEGIN
+                {_balance_refresh_sql(kind, f"{ref}.user_id", f"{ref}.{kind}_id")};
+            END''')
+        # A debt moved to another counterparty also changes the old one's balance
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{kind}_debts_balance_move
+        AFTER UPDATE OF {kind}_id ON {kind}_debts
+        WHEN OLD.{kind}_id IS NOT NEW.{kind}_id AND OLD.{kind}_id IS NOT NULL
+        BEGIN
+            {_balance_refresh_sql(kind, "OLD.user_id", f"OLD.{kind}_id")};
+        END''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{kind}_debt_payments_balance
+        AFTER INSERT ON {kind}_debt_payments
+        WHEN (SELECT {kind}_id FROM {kind}_debts WHERE id = NEW.debt_id) IS NOT NULL
+        BEGIN
+            {_balance_refresh_sql(kind, "NEW.user_id", f"(SELECT {kind}_id FROM {kind}_debts WHERE id = NEW.debt_id)")};
+        END''')
+    
+    # Stock Totals (per-tenant stock summary kept current by triggers on products; version
+    # counts changes so readers can tell when the totals moved without rescanning products)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_totals (
+        user_id INTEGER PRIMARY KEY,
+        quantity INTEGER DEFAULT 0,
+        low_stock_items INTEGER DEFAULT 0,
+        version INTEGER DEFAULT 0
+    )''')
+    for event, change in (("INSERT", _stock_change("NEW", 1)),
+                          ("UPDATE OF quantity, alert_threshold", f"{_stock_change('NEW', 1)} UNION ALL {_stock_change('OLD', -1)}"),
+                          ("DELETE", _stock_change("OLD", -1))):
+        ref = "OLD" if event == "DELETE" else "NEW"
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_products_stock_totals_{event.split()[0].lower()}
+        AFTER {event} ON products
+        BEGIN
+            INSERT INTO stock_totals (user_id, quantity, low_stock_items, version)
+            SELECT {ref}.user_id, SUM(quantity), SUM(low_stock_items), 1 FROM ({change}) WHERE true
+            ON CONFLICT (user_id) DO UPDATE SET quantity = quantity + excluded.quantity,
+                low_stock_items = low_stock_items + excluded.low_stock_items, version = version + 1;
+        END''')
+    if previous_version < 8:
+        rebuild_balances(conn)
+    if previous_version < 6:
+        rebuild_stock_totals(conn)
+    if include_users:
+        _add_column(cursor, "users", "shard", "TEXT")
+        _add_column(cursor, "tenant_purges", "shard", "TEXT")
+        if previous_version < 7:
+            _assign_existing_shards(conn)
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+def _add_column(cursor, table, column, declaration):
+    if column not in [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _assign_existing_shards(conn):
+    """Record shard files for tenants that have no rows left in the central file.
+
+    Databases from before users.shard existed routed every tenant by id; tenants whose rows
+    are still central are left unassigned so they keep reading them until split_into_shards.
+    """
+    has_central_rows = " OR ".join(f"EXISTS (SELECT 1 FROM {table} WHERE user_id = users.id)" for table in TENANT_TABLES)
+    for (user_id,) in conn.execute(f"SELECT id FROM users WHERE shard IS NULL AND NOT ({has_central_rows})").fetchall():
+        conn.execute("UPDATE users SET shard = ? WHERE id = ?", (_shard_name(user_id), user_id))
+
+# Counterparty balances
+def _balance_refresh_sql(kind, user_expr, counterparty_expr):
+    """SQL recomputing one counterparty's balance row from its own debts (an index range, not a table scan)."""
+    return f'''
+    INSERT INTO counterparty_balances
+        (user_id, counterparty_type, counterparty_id, open_amount, open_debts, last_payment_date)
+    SELECT {user_expr}, '{kind}', {counterparty_expr},
+        COALESCE(SUM(CASE WHEN d.status != 'paid' THEN d.remaining_amount END), 0),
+        COUNT(CASE WHEN d.status != 'paid' THEN 1 END),
+        (SELECT MAX(p.payment_date) FROM {kind}_debt_payments p
+         WHERE p.debt_id IN (SELECT id FROM {kind}_debts WHERE user_id = {user_expr} AND {kind}_id = {counterparty_expr}))
+    FROM {kind}_debts d
+    WHERE d.user_id = {user_expr} AND d.{kind}_id = {counterparty_expr}
+    ON CONFLICT (user_id, counterparty_type, counterparty_id) DO UPDATE SET
+        open_amount = excluded.open_amount,
+        open_debts = excluded.open_debts,
+        last_payment_date = excluded.last_payment_date'''
+
+def _expected_balances_sql(kind):
+    return f'''
+    SELECT d.user_id, '{kind}' AS counterparty_type, d.{kind}_id AS counterparty_id,
+        SUM(CASE WHEN d.status != 'paid' THEN d.remaining_amount ELSE 0 END) AS open_amount,
+        SUM(d.status != 'paid') AS open_debts,
+        MAX(p.last_payment_date) AS last_payment_date
+    FROM {kind}_debts d
+    LEFT JOIN (SELECT debt_id, MAX(payment_date) AS last_payment_date FROM {kind}_debt_payments GROUP BY debt_id) p
+        ON p.debt_id = d.id
+    WHERE d.{kind}_id IS NOT NULL
+    GROUP BY d.user_id, d.{kind}_id'''
+
+def overdue_amounts_sql(kind):
+    """Subquery of each counterparty's open debt past its due date, as of when it runs.
+
+    Takes the tenant's user_id as its one parameter; join it on counterparty_id.
+    """
+    return f'''
+    SELECT {kind}_id AS counterparty_id, SUM(remaining_amount) AS overdue_amount
+    FROM {kind}_debts
+    WHERE user_id = ? AND status != 'paid' AND due_date < DATE('now')
+    GROUP BY {kind}_id'''
+
+def rebuild_balances(conn, user_id=None):
+    """Recompute counterparty_balances from the raw debt and payment tables on conn."""
+    tenant_filter = "" if user_id is None else " WHERE user_id = ?"
+    params = () if user_id is None else (user_id,)
+    conn.execute("DELETE FROM counterparty_balances" + tenant_filter, params)
+    for kind in ("customer", "supplier"):
+        conn.execute(f"INSERT INTO counterparty_balances SELECT * FROM ({_expected_balances_sql(kind)})" + tenant_filter, params)
+
+# Stock totals
+def _stock_change(ref, sign):
+    """SQL select giving the signed quantity and low-stock contribution of one product row."""
+    return (f"SELECT {sign} * COALESCE({ref}.quantity, 0) AS quantity, "
+            f"{sign} * COALESCE({ref}.quantity <= {ref}.alert_threshold, 0) AS low_stock_items")
+
+def rebuild_stock_totals(conn):
+    """Recompute stock_totals from products on conn, bumping each tenant's version."""
+    conn.execute("DELETE FROM stock_totals WHERE user_id NOT IN (SELECT user_id FROM products)")
+    conn.execute('''
+    INSERT INTO stock_totals (user_id, quantity, low_stock_items, version)
+    SELECT user_id, SUM(COALESCE(quantity, 0)), SUM(COALESCE(quantity <= alert_threshold, 0)), 1
+    FROM products WHERE user_id IS NOT NULL GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET quantity = excluded.quantity,
+        low_stock_items = excluded.low_stock_items, version = version + 1
+    ''')
+
+def reconcile_balances(fix=False, tolerance=0.005):
+    """Compare counterparty_balances with the raw debt tables in every database file.
+
+    Returns a DataFrame of mismatched rows (stored vs expected). With fix, files that
+    have mismatches get their balances rebuilt.
+    """
+    mismatches = []
+    key = ['user_id', 'counterparty_type', 'counterparty_id']
+    for path in [DATABASE] + list_shards():
+        with connect_path(path) as conn:
+            stored = pd.read_sql('''
+            SELECT * FROM counterparty_balances
+            WHERE open_debts != 0 OR open_amount != 0 OR last_payment_date IS NOT NULL
+            ''', conn)
+            expected = pd.read_sql(f"{_expected_balances_sql('customer')} UNION ALL {_expected_balances_sql('supplier')}", conn)
+            merged = stored.merge(expected, on=key, how='outer', suffixes=('_stored', '_expected'))
+            bad = (merged['last_payment_date_stored'].fillna('') != merged['last_payment_date_expected'].fillna(''))
+            for col in ['open_amount', 'open_debts']:
+                stored_values = pd.to_numeric(merged[f"{col}_stored"]).fillna(0)
+                expected_values = pd.to_numeric(merged[f"{col}_expected"]).fillna(0)
+                bad |= (stored_values - expected_values).abs() > tolerance
+            if bad.any():
+                found = merged[bad].copy()
+                found['database'] = path
+                mismatches.append(found)
+                if fix:
+                    rebuild_balances(conn)
+    return pd.concat(mismatches, ignore_index=True) if mismatches else pd.DataFrame()
+
+# Storage router
+def _shard_name(user_id):
+    return f"shard_{(int(user_id) - 1) // TENANTS_PER_SHARD:04d}.db"
+
+def shard_path(user_id):
+    """Return the SQLite file holding user_id's rows: its assigned shard, else the central DATABASE."""
+    if user_id is None:
+        return DATABASE
+    name = _shard_names.get(user_id)
+    if name is None:
+        with connect_path(DATABASE) as conn:
+            row = conn.execute("SELECT shard FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None or row[0] is None:
+            return DATABASE  # not migrated yet; looked up again next time
+        name = _shard_names[user_id] = row[0]
+    return os.path.join(SHARD_DIR, name)
+
+def assign_shard(conn, user_id):
+    """Place a new user in a shard file; returns its name, or None while others still await migration.
+
+    conn must be a connection to the central DATABASE, normally the one that created the user.
+    New tenants stay central while any tenant is unmigrated so that split_into_shards only ever
+    copies rows whose ids came from the central file.
+    """
+    if conn.execute("SELECT 1 FROM users WHERE shard IS NULL AND id != ? LIMIT 1", (user_id,)).fetchone():
+        return None
+    name = _shard_name(user_id)
+    conn.execute("UPDATE users SET shard = ? WHERE id = ?", (name, user_id))
+    return name
+
+def list_shards():
+    if not os.path.isdir(SHARD_DIR):
+        return []
+    return sorted(os.path.join(SHARD_DIR, name) for name in os.listdir(SHARD_DIR)
+                  if name.startswith("shard_") and name.endswith(".db"))
+
+def _open_connection(path):
+    # auto_vacuum must precede WAL to apply to a new file; on an existing one it would only
+    # wait on other writers' locks for nothing
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    if new_file:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def _get_pool(path):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            if path != DATABASE:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                new_file = not os.path.exists(path)
+                conn = _open_connection(path)
+                _create_tables(conn, include_users=False)
+                if new_file:
+                    _seed_sequences(conn)
+                conn.close()
+            pool = _pools[path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return pool
+
+def _seed_sequences(conn):
+    """Start a new shard's row ids above the central file's, so copied and new rows never share an id."""
+    with sqlite3.connect(DATABASE) as central:
+        sequences = central.execute("SELECT name, seq FROM sqlite_sequence WHERE name != 'users'").fetchall()
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.executemany("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                     [(name, seq) for name, seq in sequences if name in tables])
+    conn.commit()
+
+@contextmanager
+def connect_path(path):
+    """Borrow a pooled connection to the SQLite file at path.
+
+    Commits when the block exits cleanly and rolls back on error, like sqlite3's own
+    connection context manager, then hands the connection back to that file's pool.
+    """
+    pool = _get_pool(path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(path)
+    timeout = getattr(_lock_wait, "timeout", None)
+    if timeout is not None:
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+    try:
+        with conn:
+            yield conn
+    finally:
+        if timeout is not None:
+            conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def connect(user_id=None):
+    """Borrow a pooled connection to user_id's shard, or to the central DB when None."""
+    return connect_path(shard_path(user_id))
+
+def close_pools():
+    """Close every idle pooled connection, e.g. before replacing database files."""
+    with _pools_lock:
+        for pool in _pools.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+
+# Result columns are typed by name: low-cardinality labels become categoricals, timestamps are
+# parsed once, integers are downcast and remaining text is stored as pyarrow strings
+CATEGORY_COLUMNS = {"category", "status", "entity_type", "action", "payment_method", "role", "counterparty_type"}
+DATETIME_COLUMNS = {"sale_date", "payment_date", "due_date", "created_date", "created_at", "last_restock",
+                    "last_payment_date", "timestamp", "applied_at", "requested_at", "finished_at", "date", "day"}
+
+def typed_frame(df):
+    """Convert a query result to compact dtypes in place and return it."""
+    for position, column in enumerate(df.columns):
+        values = df.iloc[:, position]
+        if column in CATEGORY_COLUMNS:
+            df.isetitem(position, values.astype("category"))
+        elif column in DATETIME_COLUMNS:
+            df.isetitem(position, pd.to_datetime(values, format="ISO8601", errors="coerce"))
+        elif pd.api.types.is_integer_dtype(values):
+            df.isetitem(position, pd.to_numeric(values, downcast="integer"))
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == "string":
+            df.isetitem(position, values.astype("string[pyarrow]"))
+    return df
+
+def query_df(user_id, query, params=()):
+    with connect(user_id) as conn:
+        return typed_frame(pd.read_sql(query, conn, params=params))
+
+def fan_out(query, params=(), tenant_column="user_id"):
+    """Run a read query on every shard and the central file and stack the results, tagging each row with its file.
+
+    Central rows are kept only for tenants not migrated yet, matched on tenant_column, so rows
+    split_into_shards copied without --delete-source are not counted twice.
+    """
+    with connect_path(DATABASE) as conn:
+        unmigrated = [row[0] for row in conn.execute("SELECT id FROM users WHERE shard IS NULL")]
+        df = typed_frame(pd.read_sql(query, conn, params=params))
+    df = df[df[tenant_column].isin(unmigrated)].reset_index(drop=True)
+    df["shard"] = os.path.basename(DATABASE)
+    frames = [df]
+    for path in list_shards():
+        with connect_path(path) as conn:
+            df = typed_frame(pd.read_sql(query, conn, params=params))
+        df["shard"] = os.path.basename(path)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+MIGRATED_TABLES = TENANT_TABLES + ["history_counters", "applied_sales"]
+
+def _table_columns(conn, table):
+    return ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+
+def _unmigrated_rows(conn, table, columns, tenant_id):
+    """Rows of the tenant in the central file that have no identical copy in the attached shard."""
+    return conn.execute(f'''
+    SELECT COUNT(*) FROM (SELECT {columns} FROM main.{table} WHERE user_id = ?
+                          EXCEPT SELECT {columns} FROM shard.{table} WHERE user_id = ?)
+    ''', (tenant_id, tenant_id)).fetchone()[0]
+
+def _migrate_tenant(tenant_id, copied):
+    """Copy one tenant into its shard and route it there, all in one transaction."""
+    path = os.path.join(SHARD_DIR, _shard_name(tenant_id))
+    _get_pool(path)  # make sure the shard file and tables exist
+    with sqlite3.connect(DATABASE, timeout=30) as central:
+        central.execute("ATTACH DATABASE ? AS shard", (path,))
+        try:
+            # Holds the write lock on both files so no sale lands in the central copy mid-migration
+            central.execute("BEGIN IMMEDIATE")
+            if central.execute("SELECT shard FROM users WHERE id = ?", (tenant_id,)).fetchone()[0] is not None:
+                central.rollback()
+                return
+            for table in MIGRATED_TABLES:
+                columns = _table_columns(central, table)
+                # Rows already copied by an interrupted run are skipped; a different row with the
+                # same id raises IntegrityError instead of being dropped
+                try:
+                    cursor = central.execute(f'''
+                    INSERT INTO shard.{table} ({columns})
+                    SELECT {columns} FROM main.{table} WHERE user_id = ?
+                    EXCEPT SELECT {columns} FROM shard.{table} WHERE user_id = ?
+                    ''', (tenant_id, tenant_id))
+                except sqlite3.IntegrityError as e:
+                    raise ValueError(f"Tenant {tenant_id}: {table} rows clash with rows already in "
+                                     f"{os.path.basename(path)} ({e}); nothing was migrated for this tenant") from e
+                copied[table] = copied.get(table, 0) + cursor.rowcount
+                if _unmigrated_rows(central, table, columns, tenant_id):
+                    raise ValueError(f"Tenant {tenant_id}: {table} copy could not be verified")
+            central.execute("UPDATE users SET shard = ? WHERE id = ?", (os.path.basename(path), tenant_id))
+            central.commit()
+        except Exception:
+            central.rollback()
+            raise
+        finally:
+            central.execute("DETACH DATABASE shard")
+
+def _delete_migrated_rows(tenant_id, path):
+    """Delete the tenant's central rows table by table, only where every row has an identical shard copy."""
+    kept = []
+    with sqlite3.connect(DATABASE, timeout=30) as central:
+        central.execute("ATTACH DATABASE ? AS shard", (path,))
+        try:
+            central.execute("BEGIN IMMEDIATE")
+            for table in MIGRATED_TABLES:
+                if _unmigrated_rows(central, table, _table_columns(central, table), tenant_id):
+                    kept.append(table)
+                else:
+                    central.execute(f"DELETE FROM main.{table} WHERE user_id = ?", (tenant_id,))
+            central.commit()
+        except Exception:
+            central.rollback()
+            raise
+        finally:
+            central.execute("DETACH DATABASE shard")
+    return kept
+
+def split_into_shards(delete_source=False, progress=None):
+    """Move every tenant still stored in the central DATABASE into its shard file.
+
+    Each tenant is copied, verified and switched to its shard in one transaction, so pages
+    keep reading the central rows until the shard holds all of them. Row ids are preserved
+    so references between tables stay valid; a re-run skips rows already copied and stops
+    with ValueError if a shard already has a different row with the same id. With
+    delete_source the central rows of migrated tenants are deleted afterwards, but only
+    from tables whose shard copy still matches. Returns {table: rows copied}.
+    """
+    copied = {}
+    with connect_path(DATABASE) as conn:
+        pending = [row[0] for row in conn.execute("SELECT id FROM users WHERE shard IS NULL ORDER BY id")]
+    for i, tenant_id in enumerate(pending):
+        _migrate_tenant(tenant_id, copied)
+        if progress:
+            progress((i + 1) / len(pending), f"Migrated tenant {tenant_id}")
+    if delete_source:
+        with connect_path(DATABASE) as conn:
+            migrated = conn.execute("SELECT id, shard FROM users WHERE shard IS NOT NULL ORDER BY id").fetchall()
+        for tenant_id, name in migrated:
+            kept = _delete_migrated_rows(tenant_id, os.path.join(SHARD_DIR, name))
+            if kept and progress:
+                progress(1.0, f"Tenant {tenant_id}: kept central {', '.join(kept)} rows that differ from the shard")
+    return copied
 
 # Helper functions
 def get_current_user_id():
     return st.session_state.user['id']
 
-def get_products(user_id):
-    with sqlite3.connect(DATABASE) as conn:
-        return pd.read_sql("SELECT * FROM products WHERE user_id = ?", conn, params=(user_id,))
+PRODUCT_COLUMNS = ("id", "name", "category", "quantity", "unit_price", "barcode", "alert_threshold",
+                   "created_date", "last_restock")
+
+def get_products(user_id, columns=PRODUCT_COLUMNS):
+    return query_df(user_id, f"SELECT {', '.join(columns)} FROM products WHERE user_id = ?", (user_id,))
+
+PRODUCT_SORT_COLUMNS = ("name", "category", "quantity", "unit_price", "alert_threshold", "created_date", "last_restock")
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def get_products_page(user_id, search="", category="", sort_by="name", descending=False, page=1, page_size=50):
+    """Return (rows for one grid page, total matching products); filtering, sorting and paging run in SQL."""
+    if sort_by not in PRODUCT_SORT_COLUMNS:
+        raise ValueError(f"Cannot sort products by {sort_by!r}")
+    where, params = "user_id = ?", [user_id]
+    if search:
+        where += " AND name LIKE ? ESCAPE '\\'"
+        params.append(_like_pattern(search))
+    if category:
+        where += " AND category LIKE ? ESCAPE '\\'"
+        params.append(_like_pattern(category))
+    direction = "DESC" if descending else "ASC"
+    with connect(user_id) as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM products WHERE {where}", params).fetchone()[0]
+        rows = pd.read_sql(f'''
+        SELECT {', '.join(PRODUCT_COLUMNS)} FROM products WHERE {where}
+        ORDER BY {sort_by} {direction}, id {direction}
+        LIMIT ? OFFSET ?
+        ''', conn, params=params + [page_size, (max(page, 1) - 1) * page_size])
+    return typed_frame(rows), total
+
+def get_low_stock(user_id, limit=200):
+    """Return (up to limit products at or below their alert threshold, total such products)."""
+    with connect(user_id) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM products WHERE user_id = ? AND quantity <= alert_threshold",
+                             (user_id,)).fetchone()[0]
+        rows = pd.read_sql('''
+        SELECT name, quantity, alert_threshold FROM products
+        WHERE user_id = ? AND quantity <= alert_threshold
+        ORDER BY quantity - alert_threshold, name LIMIT ?
+        ''', conn, params=(user_id, limit))
+    return typed_frame(rows), total
 
 def get_sales(user_id):
-    with sqlite3.connect(DATABASE) as conn:
-        return pd.read_sql('''
-            SELECT sales.*, products.name 
-            FROM sales 
-            JOIN products ON sales.product_id = products.id
-            WHERE sales.user_id = ?
-        ''', conn, params=(user_id,))
+    return query_df(user_id, '''
+        SELECT sales.id, sales.product_id, products.name, sales.quantity_sold, sales.total_price, sales.sale_date
+        FROM sales 
+        JOIN products ON sales.product_id = products.id
+        WHERE sales.user_id = ?
+    ''', (user_id,))
 
 def log_history(user_id, entity_type, entity_id, action, details):
-    with sqlite3.connect(DATABASE) as conn:
+    with connect(user_id) as conn:
+        _insert_history(conn, user_id, entity_type, entity_id, action, details)
+
+def _insert_history(conn, user_id, entity_type, entity_id, action, details):
+    """Record an event. details is stored as JSON: dicts as-is, anything else as {"message": ...}.
+
+    Actions in COUNTED_ACTIONS only bump a daily counter, so page views do not grow history.
+    """
+    if action in COUNTED_ACTIONS:
         conn.execute('''
-        INSERT INTO history (user_id, entity_type, entity_id, action, details)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, entity_type, entity_id, action, str(details)))
-        conn.commit()
\ No newline at end of file
+        INSERT INTO history_counters (user_id, day, entity_type, action, detail, count)
+        VALUES (?, DATE('now'), ?, ?, ?, 1)
+        ON CONFLICT (user_id, day, entity_type, action, detail) DO UPDATE SET count = count + 1
+        ''', (user_id, entity_type, action, str(details)))
+        return
+    if not isinstance(details, dict):
+        details = {'message': str(details)}
+    conn.execute('''
+    INSERT INTO history (user_id, entity_type, entity_id, action, details)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, entity_type, entity_id, action, json.dumps(details, default=str)))
+
+def history_cutoff():
+    """Start of the hot history window; older rows live in the archive."""
+    return (pd.Timestamp.utcnow() - pd.Timedelta(days=HISTORY_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+
+def get_history(user_id, entity_types=None):
+    """Return the tenant's history within the hot window, newest first, with details unpacked to text."""
+    query = '''
+    SELECT id, user_id, entity_type, entity_id, action,
+           CASE WHEN json_valid(details) THEN COALESCE(json_extract(details, '$.message'), details)
+                ELSE details END AS details,
+           timestamp
+    FROM history WHERE user_id = ? AND timestamp >= ?
+    '''
+    params = [user_id, history_cutoff()]
+    if entity_types:
+        query += f" AND entity_type IN ({', '.join('?' for _ in entity_types)})"
+        params.extend(entity_types)
+    query += " ORDER BY timestamp DESC"
+    return query_df(user_id, query, params)
+
+class InsufficientStock(ValueError):
+    """Raised when one or more sale lines ask for more than is in stock."""
+    def __init__(self, short):
+        self.short = short
+        super().__init__("Not enough stock: " + ", ".join(
+            f"{line['name']} (requested {line['requested']}, available {line['available']})" for line in short))
+
+def _is_lock_error(error):
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+class RestoreInProgress(ValueError):
+    """Raised by gated writes while restore_database is copying files into place."""
+    def __init__(self):
+        super().__init__("A database restore is running; try again in a moment")
+
+def restore_in_progress():
+    """True while a restore (in any process) is copying files; a marker left by a crash expires."""
+    try:
+        return time.time() - os.path.getmtime(RESTORE_MARKER) < RESTORE_MARKER_STALE
+    except OSError:
+        return False
+
+_retry_locked = retry(retry=retry_if_exception(_is_lock_error), stop=stop_after_attempt(LOCK_RETRY_ATTEMPTS),
+                      wait=wait_random_exponential(multiplier=0.05, max=2), reraise=True)
+
+def retry_on_lock(fn):
+    """Retry a write transaction that hits a held lock with jittered backoff.
+
+    Connections borrowed inside wait only WRITE_BUSY_TIMEOUT for a lock, so the backoff rather
+    than SQLite's own busy wait bounds how long a caller blocks. While a restore holds the
+    files' write locks the write is refused at once with RestoreInProgress.
+    """
+    retrying = _retry_locked(fn)
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if restore_in_progress():
+            raise RestoreInProgress()
+        previous = getattr(_lock_wait, "timeout", None)
+        _lock_wait.timeout = WRITE_BUSY_TIMEOUT
+        try:
+            return retrying(*args, **kwargs)
+        finally:
+            _lock_wait.timeout = previous
+    return wrapper
+
+def _decrement_stock(conn, user_id, items):
+    """Take each line's quantity off stock only where enough is left; raise InsufficientStock listing every short line."""
+    short = []
+    for item in items:
+        cursor = conn.execute('''
+            UPDATE products SET quantity = quantity - ? WHERE id = ? AND user_id = ? AND quantity >= ?
+        ''', (item['qty'], item['product_id'], user_id, item['qty']))
+        if cursor.rowcount == 0:
+            row = conn.execute("SELECT name, quantity FROM products WHERE id = ? AND user_id = ?",
+                               (item['product_id'], user_id)).fetchone()
+            if row is None:
+                raise ValueError(f"Unknown product {item['product_id']}")
+            short.append({'product_id': item['product_id'], 'name': row[0], 'requested': item['qty'], 'available': row[1]})
+    if short:
+        raise InsufficientStock(short)
+
+@retry_on_lock
+def record_sales(user_id, sales, source="ui", keys=None, sale_dates=None):
+    """Record one or more sales in a single transaction.
+
+    sales is a list of sales, each a list of {'product_id', 'qty', 'price'} items. Every
+    sale runs inside its own savepoint, so a sale that fails (unknown product, not enough
+    stock) is rolled back alone while the rest commit together. Returns one result per
+    sale: {'ok': True, 'sale_id', 'total'} or {'ok': False, 'error'}, plus 'short' lines
+    when stock ran out. The write lock is taken up front (BEGIN IMMEDIATE) and the whole
+    transaction is retried with jittered backoff if the database stays locked.
+
+    keys optionally gives each sale an idempotency key: a key that was already applied is
+    skipped (reported as a duplicate), so replaying the same sales twice is harmless.
+    sale_dates optionally overrides the recorded sale time of each sale.
+    """
+    results = []
+    with connect(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for index, items in enumerate(sales):
+            key = keys[index] if keys else None
+            sale_date = sale_dates[index] if sale_dates else None
+            if key is not None and conn.execute("SELECT 1 FROM applied_sales WHERE sale_key = ?", (key,)).fetchone():
+                results.append({'ok': True, 'duplicate': True})
+                continue
+            conn.execute("SAVEPOINT sale")
+            try:
+                lines = [{'product_id': item['product_id'], 'qty': int(item['qty']), 'price': float(item['price'])}
+                         for item in items]
+                _decrement_stock(conn, user_id, lines)
+                total = 0.0
+                sale_id = None
+                for line in lines:
+                    cursor = conn.execute('''
+                        INSERT INTO sales (user_id, product_id, quantity_sold, total_price, sale_date)
+                        VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                    ''', (user_id, line['product_id'], line['qty'], line['qty'] * line['price'], sale_date))
+                    sale_id = cursor.lastrowid
+                    total += line['qty'] * line['price']
+                _insert_history(conn, user_id, "sale", sale_id, "create", f"Sale: {total} for {len(items)} items" + (f" via {source}" if source != "ui" else ""))
+            except (ValueError, KeyError, TypeError, sqlite3.IntegrityError) as e:
+                conn.execute("ROLLBACK TO sale")
+                results.append({'ok': False, 'error': str(e)})
+                if isinstance(e, InsufficientStock):
+                    results[-1]['short'] = e.short
+                if key is not None:
+                    _insert_history(conn, user_id, "sale", None, "rejected", f"Rejected {source} sale {key}: {e}")
+            else:
+                results.append({'ok': True, 'sale_id': sale_id, 'total': total})
+            if key is not None:
+                conn.execute("INSERT INTO applied_sales (sale_key, user_id, sale_id) VALUES (?, ?, ?)",
+                             (key, user_id, results[-1].get('sale_id')))
+            conn.execute("RELEASE sale")
+    return results
+
+def set_stock(user_id, product_id, quantity):
+    """Set a product's stock level (restock or correction)."""
+    set_stock_levels(user_id, {product_id: quantity})
+
+@retry_on_lock
+def set_stock_levels(user_id, quantities):
+    """Write {product_id: quantity} stock levels and their history rows in one transaction."""
+    with connect(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("UPDATE products SET quantity = ?, last_restock = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?",
+                         [(quantity, product_id, user_id) for product_id, quantity in quantities.items()])
+        for product_id, quantity in quantities.items():
+            _insert_history(conn, user_id, "product", product_id, "update", f"Updated quantity to {quantity}")
+
+@retry_on_lock
+def import_products(user_id, df):
+    """Add a products DataFrame's rows in one transaction, skipping names the shop already has.
+
+    Rows are staged in a temporary table first, so the write lock is held only for the final
+    INSERT ... SELECT; a failed import adds nothing and re-uploading a file is harmless. Only
+    columns that exist on products are imported. Returns the number of rows added.
+    """
+    with connect(user_id) as conn:
+        known = {row[1] for row in conn.execute("PRAGMA table_info(products)")} - {"id"}
+        columns = [column for column in df.columns if column in known and column != "user_id"]
+        if not columns:
+            raise ValueError("CSV has no product columns")
+        if "name" not in columns:
+            raise ValueError("CSV needs a name column")
+        column_list = ", ".join(columns)
+        rows = df[columns].astype(object).where(df[columns].notna(), None).itertuples(index=False)
+        conn.execute(f"CREATE TEMP TABLE import_staging AS SELECT {column_list} FROM products WHERE 0")
+        try:
+            conn.executemany(f"INSERT INTO import_staging VALUES ({', '.join('?' for _ in columns)})", rows)
+            conn.commit()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = conn.execute(f'''
+                INSERT INTO products (user_id, {column_list})
+                SELECT ?, {column_list} FROM import_staging WHERE true
+                ON CONFLICT (user_id, name) DO NOTHING
+                ''', (user_id,)).rowcount
+            except sqlite3.IntegrityError as e:
+                raise ValueError(f"Nothing imported: {e}")
+            conn.commit()
+        finally:
+            conn.rollback()
+            conn.execute("DROP TABLE temp.import_staging")
+    return added
+
+def get_debt_remaining(user_id, kind, debt_id):
+    """Return the current remaining amount of a customer or supplier debt (0 if it no longer exists)."""
+    with connect(user_id) as conn:
+        row = conn.execute(f"SELECT remaining_amount FROM {kind}_debts WHERE id = ? AND user_id = ?",
+                           (debt_id, user_id)).fetchone()
+    return float(row[0]) if row else 0.0
+
+@retry_on_lock
+def record_debt_payment(user_id, kind, debt_id, amount, payment_method):
+    """Apply a payment to a customer or supplier debt and return the remaining amount."""
+    with connect(user_id) as conn:
+        conn.execute(f'''
+        INSERT INTO {kind}_debt_payments (user_id, debt_id, amount, payment_method)
+        VALUES (?, ?, ?, ?)
+        ''', (user_id, debt_id, amount, payment_method))
+        cursor = conn.execute(f'''
+        UPDATE {kind}_debts SET remaining_amount = remaining_amount - ? WHERE id = ? AND user_id = ?
+        ''', (amount, debt_id, user_id))
+        if cursor.rowcount == 0:
+            raise ValueError(f"Unknown {kind} debt {debt_id}")
+        remaining = conn.execute(f"SELECT remaining_amount FROM {kind}_debts WHERE id = ? AND user_id = ?",
+                                 (debt_id, user_id)).fetchone()[0]
+        if remaining <= 0:
+            conn.execute(f"UPDATE {kind}_debts SET status = 'paid' WHERE id = ? AND user_id = ?", (debt_id, user_id))
+        _insert_history(conn, user_id, f"{kind}_debt", debt_id, "payment", f"Paid ₹{amount} on debt {debt_id}")
+    return remaining
+
+# API tokens
+def _hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_api_token(user_id, label=""):
+    """Issue a new API token for user_id. Only its hash is stored, so the token is shown once."""
+    token = secrets.token_urlsafe(32)
+    with connect() as conn:
+        conn.execute("INSERT INTO api_tokens (token_hash, user_id, label) VALUES (?, ?, ?)",
+                     (_hash_token(token), user_id, label))
+    return token
+
+def resolve_api_token(token):
+    """Return the user id for an API token, or None if it is unknown."""
+    with connect() as conn:
+        row = conn.execute("SELECT user_id FROM api_tokens WHERE token_hash = ?", (_hash_token(token),)).fetchone()
+    return row[0] if row else None
+
+# Backup / restore
+def validate_database_file(path, required=REQUIRED_TABLES):
+    """Return a list of problems with the SQLite file at path; empty if it can be restored."""
+    try:
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+            integrity = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+            if integrity != ["ok"]:
+                return [f"Integrity check failed: {msg}" for msg in integrity[:10]]
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    except sqlite3.DatabaseError as e:
+        return [f"Not a valid SQLite database: {e}"]
+    problems = []
+    if version > SCHEMA_VERSION:
+        problems.append(f"Backup schema version {version} is newer than this app supports ({SCHEMA_VERSION})")
+    missing = required - tables
+    if missing:
+        problems.append(f"Missing tables: {', '.join(sorted(missing))}")
+    return problems
+
+def _referenced_shards(path):
+    """Shard files the users table of a validated central file routes tenants to."""
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+        if "shard" not in [row[1] for row in conn.execute("PRAGMA table_info(users)")]:
+            return set()
+        return {row[0] for row in conn.execute("SELECT DISTINCT shard FROM users WHERE shard IS NOT NULL")}
+
+def backup_database(dest, progress=None):
+    """Write a zip backup of the central file and every shard to dest.
+
+    Each file is snapshotted with SQLite's online backup API, so rows still in the WAL
+    are included and writers are not blocked. progress(fraction, message) is optional.
+    """
+    # Shards of tenants that have not written anything yet are created empty so the backup lists them
+    shards = set(list_shards()) | {os.path.join(SHARD_DIR, name) for name in _referenced_shards(DATABASE)}
+    files = [(DATABASE, "inventory.db")] + [(path, f"shards/{os.path.basename(path)}") for path in sorted(shards)]
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(DATABASE))) as workdir, \
+            zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as archive:
+        for i, (path, name) in enumerate(files):
+            if progress:
+                progress(i / len(files), f"Backing up {name}...")
+            snapshot = os.path.join(workdir, os.path.basename(path))
+            with connect_path(path) as src, sqlite3.connect(snapshot) as dst:
+                src.backup(dst)
+            dst.close()
+            archive.write(snapshot, name)
+            os.remove(snapshot)
+    if progress:
+        progress(1.0, "Backup complete")
+
+def _spool_upload(uploaded_file, tmp_path, report):
+    total_size = getattr(uploaded_file, "size", None)
+    uploaded_file.seek(0)
+    written = 0
+    with open(tmp_path, "wb") as tmp:
+        while True:
+            chunk = uploaded_file.read(RESTORE_CHUNK_SIZE)
+            if not chunk:
+                break
+            tmp.write(chunk)
+            written += len(chunk)
+            if total_size:
+                report(0.3 * written / total_size, "Uploading backup...")
+        tmp.flush()
+        os.fsync(tmp.fileno())
+
+def _extract_backup(zip_path, workdir):
+    """Unpack a backup zip into workdir; returns {member name: extracted path}."""
+    files = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.namelist():
+            if not BACKUP_MEMBER.match(member):
+                raise ValueError(f"Unexpected file in backup: {member}")
+            files[member] = os.path.join(workdir, member.replace("/", "_"))
+            with archive.open(member) as src, open(files[member], "wb") as dst:
+                while True:
+                    chunk = src.read(RESTORE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+    if "inventory.db" not in files:
+        raise ValueError("Backup does not contain inventory.db")
+    return files
+
+def _copy_database(src_path, dst_path, on_step):
+    with sqlite3.connect(f"file:{src_path}?mode=ro", uri=True) as src, \
+            sqlite3.connect(dst_path, timeout=30) as dst:
+        src.backup(dst, pages=RESTORE_PAGES_PER_STEP, progress=on_step)
+    src.close()
+    dst.close()
+
+def restore_database(uploaded_file, progress=None):
+    """Validate an uploaded backup and copy it into the live databases.
+
+    Accepts a zip from backup_database (central file plus shards) or a single-file
+    backup from before sharding. The upload is streamed to a temp file in chunks, every
+    file is checked with PRAGMA integrity_check and a schema check and brought up to the
+    current schema, then copied into place through SQLite's online backup API. Readers
+    keep seeing the old contents until a file's copy commits, but the copy holds that
+    file's write lock until it finishes, so writes pause for each file in turn. Writes
+    behind retry_on_lock are refused with RestoreInProgress while RESTORE_MARKER exists
+    instead of waiting on the lock. Shards that are not in the backup are emptied,
+    since the backup describes every tenant. progress(fraction, message) is called as
+    the restore advances. Raises ValueError if the backup is rejected.
+    """
+    def report(fraction, message):
+        if progress:
+            progress(min(fraction, 1.0), message)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(DATABASE))) as workdir:
+        upload_path = os.path.join(workdir, "upload")
+        _spool_upload(uploaded_file, upload_path, report)
+
+        report(0.3, "Checking backup integrity...")
+        if zipfile.is_zipfile(upload_path):
+            files = _extract_backup(upload_path, workdir)
+            os.remove(upload_path)
+        else:
+            files = {"inventory.db": upload_path}
+        problems = validate_database_file(files["inventory.db"])
+        if problems:
+            raise ValueError("; ".join(problems))
+        shards = {os.path.basename(name): path for name, path in files.items() if name != "inventory.db"}
+        for name, path in shards.items():
+            problems += [f"{name}: {problem}" for problem in
+                         validate_database_file(path, REQUIRED_TABLES - {"users"})]
+        missing = _referenced_shards(files["inventory.db"]) - set(shards)
+        if missing:
+            problems.append(f"Backup is missing shard files: {', '.join(sorted(missing))}")
+        if problems:
+            raise ValueError("; ".join(problems))
+
+        # Shards that exist now but not in the backup get an empty copy of the schema
+        empty_path = os.path.join(workdir, "empty.db")
+        with sqlite3.connect(empty_path) as conn:
+            _create_tables(conn, include_users=False)
+        conn.close()
+        # Bring older backups up to the current schema before any live file is locked
+        report(0.35, "Upgrading backup schema...")
+        for name, path in files.items():
+            with sqlite3.connect(path) as conn:
+                _create_tables(conn, include_users=name == "inventory.db")
+            conn.close()
+        targets = [(files["inventory.db"], DATABASE)]
+        for path in sorted(set(shards) | {os.path.basename(path) for path in list_shards()}):
+            targets.append((shards.get(path, empty_path), os.path.join(SHARD_DIR, path)))
+
+        close_pools()
+        _shard_names.clear()
+        os.makedirs(SHARD_DIR, exist_ok=True)
+        open(RESTORE_MARKER, "w").close()
+        try:
+            for i, (src_path, dst_path) in enumerate(targets):
+                def on_step(status, remaining, total, i=i):
+                    os.utime(RESTORE_MARKER)  # keep the marker fresh through a long copy
+                    if total:
+                        report(0.4 + 0.6 * (i + (total - remaining) / total) / len(targets), "Restoring database...")
+                report(0.4 + 0.6 * i / len(targets), "Restoring database...")
+                _copy_database(src_path, dst_path, on_step)
+        finally:
+            os.remove(RESTORE_MARKER)
+        report(1.0, "Restore complete")
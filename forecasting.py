@@ -0,0 +1,293 @@
+import datetime
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from database import connect, query_df, retry_on_lock
+
+HISTORY_DAYS = 730      # sales history considered by the forecast
+VELOCITY_DAYS = 28      # recent window used for the current sales rate
+LEAD_TIME_DAYS = 7      # days between placing an order and receiving stock
+REVIEW_DAYS = 14        # days of demand an order should cover beyond the reorder point
+SERVICE_Z = 1.65        # safety stock multiplier (~95% service level)
+SEASONALITY_PRIOR_WEEKS = 4  # weeks of history needed before weekday patterns get half weight
+
+_refresh_lock = threading.Lock()
+_refresh_threads = {}
+
+# demand_stats holds, per product, sums of sales_daily rows inside the forecast windows ending on
+# forecast_state.stats_day. Each refresh adds newly rolled-up sales and subtracts the days that
+# left a window since, so daily work follows one day of rows rather than HISTORY_DAYS of them.
+WEEKDAY_COLUMNS = [f"weekday_{day}" for day in range(7)]  # Monday first
+STATS_COLUMNS = ['total', 'total_sq', 'recent', 'first_day'] + WEEKDAY_COLUMNS
+DEMAND_COLUMNS = ['product_id', 'total', 'total_sq', 'recent', 'first_age'] + WEEKDAY_COLUMNS
+
+def _weekday_sums(day, quantity):
+    # strftime('%w') counts from Sunday
+    return ", ".join(f"SUM(CASE strftime('%w', {day}) WHEN '{(weekday + 1) % 7}' THEN {quantity} ELSE 0 END)"
+                     for weekday in range(7))
+
+# Adds the rows of a (product_id, total, total_sq, recent, first_day, weekday_0..6) select to demand_stats
+STATS_UPSERT = f'''
+INSERT INTO demand_stats (user_id, product_id, {", ".join(STATS_COLUMNS)})
+SELECT :user_id, * FROM ({{select}}) WHERE true
+ON CONFLICT (user_id, product_id) DO UPDATE SET
+    {", ".join(f"{column} = {column} + excluded.{column}" for column in STATS_COLUMNS if column != "first_day")},
+    first_day = CASE WHEN first_day IS NULL OR excluded.first_day < first_day THEN excluded.first_day ELSE first_day END
+'''
+NEW_SALES = '''
+SELECT product_id, DATE(sale_date) AS day, SUM(quantity_sold) AS quantity
+FROM sales WHERE user_id = :user_id AND id > :after AND id <= :upto
+GROUP BY product_id, DATE(sale_date)
+'''
+# A day's rollup grows from a to a + b, so its square grows by b * (b + 2a)
+ADDED_DEMAND = f'''
+SELECT n.product_id, SUM(n.quantity), SUM(n.quantity * (n.quantity + 2 * COALESCE(s.quantity, 0))),
+       SUM(CASE WHEN n.day >= :recent_start THEN n.quantity ELSE 0 END), MIN(n.day),
+       {_weekday_sums("n.day", "n.quantity")}
+FROM ({NEW_SALES}) n
+LEFT JOIN sales_daily s ON s.user_id = :user_id AND s.product_id = n.product_id AND s.day = n.day
+WHERE n.day >= :since
+GROUP BY n.product_id
+'''
+EXPIRED_HISTORY = f'''
+SELECT product_id, -SUM(quantity), -SUM(quantity * quantity), 0, NULL, {_weekday_sums("day", "-quantity")}
+FROM sales_daily WHERE user_id = :user_id AND day >= :old_since AND day < :since
+GROUP BY product_id
+'''
+EXPIRED_RECENT = f'''
+SELECT product_id, 0, 0, -SUM(quantity), NULL, {", ".join(["0"] * 7)}
+FROM sales_daily WHERE user_id = :user_id AND day >= :old_recent_start AND day < :recent_start
+GROUP BY product_id
+'''
+
+def _windows(today):
+    return {'since': (today - datetime.timedelta(days=HISTORY_DAYS - 1)).isoformat(),
+            'recent_start': (today - datetime.timedelta(days=VELOCITY_DAYS - 1)).isoformat()}
+
+@retry_on_lock
+def update_demand(user_id, today):
+    """Fold sales newer than the tenant's watermark into sales_daily and demand_stats.
+
+    Runs in one short transaction. Returns (window, stale): window is the (previous, new)
+    sale id watermarks when new sales were rolled up, else None; stale is True when
+    demand_stats has never been built (or the clock went back) and needs rebuild_demand.
+    """
+    params = {'user_id': user_id, **_windows(today)}
+    with connect(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT OR IGNORE INTO forecast_state (user_id, last_sale_id) VALUES (?, 0)", (user_id,))
+        last_sale_id, stats_day = conn.execute("SELECT last_sale_id, stats_day FROM forecast_state WHERE user_id = ?",
+                                               (user_id,)).fetchone()
+        stale = stats_day is None or stats_day > today.isoformat()
+        if not stale and stats_day < today.isoformat():
+            previous = _windows(datetime.date.fromisoformat(stats_day))
+            params.update(old_since=previous['since'], old_recent_start=previous['recent_start'])
+            conn.execute(STATS_UPSERT.format(select=EXPIRED_HISTORY), params)
+            conn.execute(STATS_UPSERT.format(select=EXPIRED_RECENT), params)
+            conn.execute('''
+            UPDATE demand_stats SET first_day = (
+                SELECT MIN(day) FROM sales_daily s
+                WHERE s.user_id = demand_stats.user_id AND s.product_id = demand_stats.product_id AND s.day >= :since
+            )
+            WHERE user_id = :user_id AND first_day < :since
+            ''', params)
+            conn.execute("DELETE FROM demand_stats WHERE user_id = :user_id AND first_day IS NULL", params)
+            conn.execute("UPDATE forecast_state SET stats_day = ? WHERE user_id = ?", (today.isoformat(), user_id))
+        max_sale_id = conn.execute("SELECT MAX(id) FROM sales WHERE user_id = ?", (user_id,)).fetchone()[0]
+        if max_sale_id is None or max_sale_id <= last_sale_id:
+            return None, stale
+        params.update(after=last_sale_id, upto=max_sale_id)
+        if not stale:
+            conn.execute(STATS_UPSERT.format(select=ADDED_DEMAND), params)
+        conn.execute(f'''
+        INSERT INTO sales_daily (user_id, product_id, day, quantity)
+        SELECT :user_id, product_id, day, quantity FROM ({NEW_SALES}) WHERE true
+        ON CONFLICT (user_id, product_id, day) DO UPDATE SET quantity = quantity + excluded.quantity
+        ''', params)
+        conn.execute("UPDATE forecast_state SET last_sale_id = ? WHERE user_id = ?", (max_sale_id, user_id))
+    return (last_sale_id, max_sale_id), stale
+
+@contextmanager
+def _write(user_id):
+    with connect(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+def rebuild_demand(user_id, today, attempts=3):
+    """Recompute the tenant's demand_stats from the whole rollup window.
+
+    The rollup is aggregated outside any write lock (grouped by product and weekday, so one
+    date function runs per row) and published in a short transaction, unless more sales
+    were rolled up meanwhile, in which case it starts over. Returns True once published.
+    """
+    params = {'user_id': user_id, **_windows(today)}
+    for _ in range(attempts):
+        with connect(user_id) as conn:
+            watermark = conn.execute("SELECT last_sale_id FROM forecast_state WHERE user_id = ?", (user_id,)).fetchone()[0]
+            grouped = pd.DataFrame(conn.execute('''
+            SELECT product_id, (CAST(strftime('%w', day) AS INTEGER) + 6) % 7, SUM(quantity), SUM(quantity * quantity),
+                   SUM(CASE WHEN day >= :recent_start THEN quantity ELSE 0 END), MIN(day)
+            FROM sales_daily WHERE user_id = :user_id AND day >= :since
+            GROUP BY product_id, 2
+            ''', params).fetchall(), columns=['product_id', 'weekday', 'total', 'total_sq', 'recent', 'first_day'])
+        stats = grouped.groupby('product_id').agg(total=('total', 'sum'), total_sq=('total_sq', 'sum'),
+                                                  recent=('recent', 'sum'), first_day=('first_day', 'min'))
+        by_weekday = grouped.pivot(index='product_id', columns='weekday', values='total').reindex(columns=range(7))
+        stats[WEEKDAY_COLUMNS] = by_weekday.reindex(stats.index).fillna(0).astype(np.int64).to_numpy()
+        with _write(user_id) as conn:
+            if conn.execute("SELECT last_sale_id FROM forecast_state WHERE user_id = ?", (user_id,)).fetchone()[0] != watermark:
+                continue
+            conn.execute("DELETE FROM demand_stats WHERE user_id = ?", (user_id,))
+            conn.executemany(f'''
+            INSERT INTO demand_stats (user_id, product_id, {", ".join(STATS_COLUMNS)})
+            VALUES ({", ".join("?" * (len(STATS_COLUMNS) + 2))})
+            ''', ((user_id, product_id, *row) for product_id, row in zip(stats.index.tolist(), stats[STATS_COLUMNS].itertuples(index=False))))
+            conn.execute("UPDATE forecast_state SET stats_day = ? WHERE user_id = ?", (today.isoformat(), user_id))
+            return True
+    return False
+
+def load_demand(conn, params, products=""):
+    """Read demand_stats as DEMAND_COLUMNS float columns, first_day turned into days before today."""
+    rows = conn.execute(f'''
+    SELECT product_id, total, total_sq, recent, CAST(julianday(:today) - julianday(first_day) AS INTEGER),
+           {", ".join(WEEKDAY_COLUMNS)}
+    FROM demand_stats WHERE user_id = :user_id{products}
+    ''', params).fetchall()
+    demand = pd.DataFrame(np.array(rows, dtype=np.float64).reshape(-1, len(DEMAND_COLUMNS)), columns=DEMAND_COLUMNS)
+    demand['product_id'] = demand['product_id'].astype(np.int64)
+    return demand
+
+def compute_reorder_points(demand, stock, today):
+    """Forecast demand for a whole catalog in one pass.
+
+    demand has one row per product with sales, as returned by load_demand: total and
+    total_sq of daily quantities, recent (last VELOCITY_DAYS), first_age (days since the
+    first sale in the window) and weekday_0..weekday_6 totals (Monday first). stock has
+    product_id, quantity. Returns one row per product in stock with the daily velocity,
+    weekday-adjusted lead time demand, reorder point and suggested order quantity.
+    """
+    result = stock[['product_id', 'quantity']].copy()
+    if demand.empty:
+        result['daily_velocity'] = 0.0
+        result['lead_time_demand'] = 0.0
+        result['reorder_point'] = 0
+        result['order_quantity'] = 0
+        return result
+
+    today = pd.Timestamp(today)
+    product_ids = demand['product_id'].to_numpy()
+
+    # Days each product has been selling, capped to the history window
+    span = np.clip(demand['first_age'].to_numpy() + 1, 1, HISTORY_DAYS)
+
+    total = demand['total'].to_numpy()
+    total_sq = demand['total_sq'].to_numpy()
+    recent = demand['recent'].to_numpy()
+    mean = total / span
+    std = np.sqrt(np.maximum(total_sq / span - mean * mean, 0.0))
+    velocity = recent / np.minimum(span, VELOCITY_DAYS)
+
+    # Weekday seasonality index, shrunk towards 1 while history is short
+    by_weekday = demand[WEEKDAY_COLUMNS].to_numpy()
+    weeks = span / 7
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw_index = np.where(mean[:, None] > 0, by_weekday / weeks[:, None] / mean[:, None], 1.0)
+    weight = (weeks / (weeks + SEASONALITY_PRIOR_WEEKS))[:, None]
+    season = weight * raw_index + (1 - weight)
+
+    def upcoming_weekdays(horizon):
+        upcoming = (today.weekday() + 1 + np.arange(horizon)) % 7
+        return np.bincount(upcoming, minlength=7)
+
+    lead_demand = velocity * (season @ upcoming_weekdays(LEAD_TIME_DAYS))
+    review_demand = velocity * (season @ upcoming_weekdays(REVIEW_DAYS))
+    forecast = pd.DataFrame({
+        'product_id': product_ids,
+        'daily_velocity': velocity,
+        'lead_time_demand': lead_demand,
+        'reorder_point': np.ceil(lead_demand + SERVICE_Z * std * np.sqrt(LEAD_TIME_DAYS)),
+        'review_demand': review_demand,
+    })
+    result = result.merge(forecast, on='product_id', how='left').fillna(0)
+    result['reorder_point'] = result['reorder_point'].astype(int)
+    result['order_quantity'] = np.maximum(
+        np.ceil(result['reorder_point'] + result['review_demand'] - result['quantity']), 0).astype(int)
+    return result.drop(columns='review_demand')
+
+STOCK_QUERY = "SELECT id AS product_id, quantity FROM products WHERE user_id = :user_id{products}"
+# Restricts a query to products sold between two rollup watermarks
+CHANGED_PRODUCTS = " AND {column} IN (SELECT product_id FROM sales WHERE user_id = :user_id AND id > :after AND id <= :upto)"
+
+def refresh_forecasts(user_id, force=False):
+    """Bring the stored reorder suggestions up to date; returns how many products were recomputed.
+
+    Only sales recorded since the last run are rolled up. The whole catalog is recomputed once
+    a day (or with force, which also rebuilds demand_stats); in between, only products that
+    sold since the last run are. Suggestions are computed from demand_stats, one row per product.
+    """
+    today = datetime.date.today()
+    window, stale = update_demand(user_id, today)
+    if (stale or force) and not rebuild_demand(user_id, today):
+        return 0  # sales kept arriving during the rebuild; the next refresh tries again
+    with connect(user_id) as conn:
+        computed_date = conn.execute("SELECT computed_date FROM forecast_state WHERE user_id = ?", (user_id,)).fetchone()[0]
+        full = force or stale or computed_date != today.isoformat()
+        if not full and window is None:
+            return 0
+        params = {'user_id': user_id, 'today': today.isoformat()}
+        if full:
+            demand = load_demand(conn, params)
+            stock = pd.read_sql(STOCK_QUERY.format(products=""), conn, params=params)
+        else:
+            params['after'], params['upto'] = window
+            demand = load_demand(conn, params, CHANGED_PRODUCTS.format(column="product_id"))
+            stock = pd.read_sql(STOCK_QUERY.format(products=CHANGED_PRODUCTS.format(column="id")), conn, params=params)
+    suggestions = compute_reorder_points(demand, stock, today)
+    with _write(user_id) as conn:
+        if full:
+            conn.execute("DELETE FROM reorder_suggestions WHERE user_id = ?", (user_id,))
+        conn.executemany('''
+        INSERT OR REPLACE INTO reorder_suggestions (user_id, product_id, daily_velocity, lead_time_demand, reorder_point, order_quantity)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', zip([user_id] * len(suggestions), suggestions['product_id'].tolist(), suggestions['daily_velocity'].tolist(),
+                 suggestions['lead_time_demand'].tolist(), suggestions['reorder_point'].tolist(),
+                 suggestions['order_quantity'].tolist()))
+        conn.execute("UPDATE forecast_state SET computed_date = ? WHERE user_id = ?", (today.isoformat(), user_id))
+    return len(suggestions)
+
+def start_forecast_refresh(user_id):
+    """Refresh a tenant's forecasts in a background thread unless one is already running."""
+    with _refresh_lock:
+        thread = _refresh_threads.get(user_id)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=refresh_forecasts, args=(user_id,), name=f"forecast-{user_id}", daemon=True)
+            _refresh_threads[user_id] = thread
+            thread.start()
+
+def get_reorder_suggestions(user_id, reorder_only=False):
+    """Return the stored suggestions joined with product names; never recomputes.
+
+    With reorder_only, only selling products at or below their reorder point are returned.
+    """
+    return query_df(user_id, f'''
+    SELECT p.id AS product_id, p.name, p.quantity, p.alert_threshold,
+           r.daily_velocity, r.reorder_point, r.order_quantity
+    FROM reorder_suggestions r
+    JOIN products p ON p.id = r.product_id AND p.user_id = r.user_id
+    WHERE r.user_id = ?{" AND r.daily_velocity > 0 AND p.quantity <= r.reorder_point" if reorder_only else ""}
+    ''', (user_id,))
+
+def apply_suggested_thresholds(user_id):
+    """Copy reorder points into products.alert_threshold for products with sales history."""
+    with connect(user_id) as conn:
+        cursor = conn.execute('''
+        UPDATE products SET alert_threshold = (
+            SELECT reorder_point FROM reorder_suggestions r
+            WHERE r.user_id = products.user_id AND r.product_id = products.id
+        )
+        WHERE user_id = ? AND id IN (
+            SELECT product_id FROM reorder_suggestions WHERE user_id = ? AND daily_velocity > 0
+        )
+        ''', (user_id, user_id))
+        return cursor.rowcount
@@ -0,0 +1,81 @@
+"""Retention and compaction for the history table.
+
+Rows older than HISTORY_RETENTION_DAYS are copied into gzip-compressed JSONL files, one
+per database file and month (history_archive/<db>/<YYYY-MM>.jsonl.gz), and then deleted.
+Work happens in small chunks: each chunk is read without a write lock, appended and
+fsynced to its archive file, and then deleted in its own short transaction. A crash
+between the append and the delete can leave a row archived twice, never lost; readers
+de-duplicate on the row id.
+"""
+import gzip
+import json
+import os
+import time
+from database import DATABASE, connect_path, history_cutoff, list_shards
+
+ARCHIVE_DIR = os.environ.get("RETAILPULSE_HISTORY_ARCHIVE_DIR", "history_archive")
+COMPACT_CHUNK_ROWS = 500  # rows archived and deleted per transaction
+COMPACT_PAUSE = 0.05      # seconds between chunks so other writers get the lock
+
+COLUMNS = ["id", "user_id", "entity_type", "entity_id", "action", "details", "timestamp"]
+
+def _archive_path(db_path, month):
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(ARCHIVE_DIR, name, f"{month}.jsonl.gz")
+
+def _append(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Each call adds a new gzip member; gzip readers treat concatenated members as one stream
+    with open(path, "ab") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+            for row in rows:
+                record = dict(zip(COLUMNS, row))
+                try:
+                    record['details'] = json.loads(record['details'])
+                except (TypeError, ValueError):
+                    pass
+                gz.write((json.dumps(record, default=str) + "\n").encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+def compact_file(db_path, cutoff=None, progress=None):
+    """Archive and delete history rows older than cutoff in one database file; returns rows moved."""
+    cutoff = cutoff or history_cutoff()
+    moved = 0
+    while True:
+        with connect_path(db_path) as conn:
+            rows = conn.execute(f'''
+            SELECT {', '.join(COLUMNS)} FROM history WHERE timestamp < ? ORDER BY id LIMIT ?
+            ''', (cutoff, COMPACT_CHUNK_ROWS)).fetchall()
+        if not rows:
+            return moved
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(str(row[6])[:7], []).append(row)
+        for month, month_rows in by_month.items():
+            _append(_archive_path(db_path, month), month_rows)
+        with connect_path(db_path) as conn:
+            conn.execute(f"DELETE FROM history WHERE id IN ({', '.join('?' for _ in rows)})", [row[0] for row in rows])
+        moved += len(rows)
+        if progress:
+            progress(db_path, moved)
+        time.sleep(COMPACT_PAUSE)
+
+def compact_history(progress=None):
+    """Run retention over the central database and every shard; returns {file: rows archived}."""
+    cutoff = history_cutoff()
+    return {path: compact_file(path, cutoff, progress) for path in [DATABASE] + list_shards()}
+
+def read_archive(db_path, month, user_id=None):
+    """Yield archived history records for one database file and month (YYYY-MM)."""
+    path = _archive_path(db_path, month)
+    if not os.path.exists(path):
+        return
+    seen = set()
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            record = json.loads(line)
+            if record['id'] in seen or (user_id is not None and record['user_id'] != user_id):
+                continue
+            seen.add(record['id'])
+            yield record
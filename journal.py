@@ -0,0 +1,183 @@
+"""Append-only sale journal.
+
+With RETAILPULSE_SALE_JOURNAL=1 the Sales page does not write to SQLite at checkout.
+Each sale is appended to a segment file under JOURNAL_DIR and fsynced, which is
+acknowledged straight away, and a background applier replays the journal into
+sales/products in large batched transactions. Every entry carries a unique key that
+record_sales stores in applied_sales in the same transaction, so replaying after a crash
+never applies a sale twice. Sales that fail on replay (e.g. stock ran out) are recorded
+in history as 'rejected'; entries of users deleted since they were journaled are dropped.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+from database import record_sales
+from tenant_purge import purged_user_ids
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialised within this process
+    fcntl = None
+
+JOURNAL_ENABLED = os.environ.get("RETAILPULSE_SALE_JOURNAL", "0") == "1"
+JOURNAL_DIR = os.environ.get("RETAILPULSE_JOURNAL_DIR", "journal")
+SEGMENT_BYTES = 16 * 1024 * 1024  # start a new segment once the current one reaches this size
+APPLY_BATCH = 2000                 # entries replayed per applier pass
+APPLY_INTERVAL = 0.5               # seconds the applier sleeps when the journal is drained
+CHECKPOINT_FILE = "checkpoint.json"
+
+_append_lock = threading.Lock()
+_applier_lock = threading.Lock()
+_applier_thread = None
+_stats = {'applied': 0, 'rejected': 0, 'dropped': 0, 'last_apply': None, 'last_error': None}
+
+def _segments():
+    if not os.path.isdir(JOURNAL_DIR):
+        return []
+    return sorted(name for name in os.listdir(JOURNAL_DIR) if name.startswith("segment_") and name.endswith(".jsonl"))
+
+def _segment_name(seq):
+    return f"segment_{seq:08d}.jsonl"
+
+def _segment_seq(name):
+    return int(name[len("segment_"):-len(".jsonl")])
+
+def append_sale(user_id, items):
+    """Durably append a sale to the journal and return its key once it is on disk."""
+    entry = {
+        'key': uuid.uuid4().hex,
+        'user_id': user_id,
+        'items': [{'product_id': item['product_id'], 'qty': item['qty'], 'price': item['price']} for item in items],
+        'sale_date': datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    line = (json.dumps(entry) + "\n").encode()
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    with _append_lock, open(os.path.join(JOURNAL_DIR, ".lock"), "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        segments = _segments()
+        name = segments[-1] if segments else _segment_name(1)
+        path = os.path.join(JOURNAL_DIR, name)
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_BYTES:
+            path = os.path.join(JOURNAL_DIR, _segment_name(_segment_seq(name) + 1))
+        fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # A crash mid-append can leave a torn last line; terminate it so this entry stays readable
+            if os.fstat(fd).st_size and os.pread(fd, 1, os.fstat(fd).st_size - 1) != b"\n":
+                line = b"\n" + line
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return entry['key']
+
+def _read_checkpoint():
+    try:
+        with open(os.path.join(JOURNAL_DIR, CHECKPOINT_FILE)) as f:
+            checkpoint = json.load(f)
+        return checkpoint['segment'], checkpoint['offset']
+    except (OSError, ValueError, KeyError):
+        segments = _segments()
+        return (segments[0] if segments else _segment_name(1)), 0
+
+def _write_checkpoint(segment, offset):
+    path = os.path.join(JOURNAL_DIR, CHECKPOINT_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({'segment': segment, 'offset': offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def _read_pending(limit):
+    """Return (entries, segment, offset) for up to limit complete entries after the checkpoint."""
+    segment, offset = _read_checkpoint()
+    entries = []
+    for name in _segments():
+        if name < segment:
+            continue
+        if name > segment:
+            segment, offset = name, 0
+        with open(os.path.join(JOURNAL_DIR, name), "rb") as f:
+            f.seek(offset)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # end of segment, or a write still in progress
+                offset += len(line)
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    _stats['last_error'] = f"Skipped corrupt journal line in {name}"
+        if len(entries) >= limit:
+            break
+    return entries, segment, offset
+
+def apply_pending(limit=APPLY_BATCH):
+    """Replay up to limit journal entries into the database; returns how many were processed."""
+    entries, segment, offset = _read_pending(limit)
+    if not entries:
+        return 0
+    purged = purged_user_ids()
+    by_tenant = {}
+    for entry in entries:
+        if entry['user_id'] in purged:
+            _stats['dropped'] += 1
+            continue
+        by_tenant.setdefault(entry['user_id'], []).append(entry)
+    for user_id, tenant_entries in by_tenant.items():
+        results = record_sales(user_id, [entry['items'] for entry in tenant_entries], "journal",
+                               keys=[entry['key'] for entry in tenant_entries],
+                               sale_dates=[entry['sale_date'] for entry in tenant_entries])
+        _stats['applied'] += sum(result['ok'] and not result.get('duplicate') for result in results)
+        _stats['rejected'] += sum(not result['ok'] for result in results)
+    _write_checkpoint(segment, offset)
+    _stats['last_apply'] = time.time()
+    # Segments before the checkpoint are fully applied
+    for name in _segments():
+        if name < segment:
+            os.remove(os.path.join(JOURNAL_DIR, name))
+    return len(entries)
+
+def _applier_loop():
+    while True:
+        try:
+            if apply_pending() < APPLY_BATCH:
+                time.sleep(APPLY_INTERVAL)
+        except Exception as e:  # database busy or unavailable: keep the journal and retry
+            _stats['last_error'] = str(e)
+            time.sleep(APPLY_INTERVAL * 4)
+
+def start_applier():
+    """Start the background applier thread once per process."""
+    global _applier_thread
+    with _applier_lock:
+        if _applier_thread is None or not _applier_thread.is_alive():
+            _applier_thread = threading.Thread(target=_applier_loop, name="sale-journal-applier", daemon=True)
+            _applier_thread.start()
+
+def journal_lag():
+    """Return lag metrics: entries and bytes not yet applied, and the age of the oldest one."""
+    segment, offset = _read_checkpoint()
+    pending_bytes = 0
+    for name in _segments():
+        if name >= segment:
+            size = os.path.getsize(os.path.join(JOURNAL_DIR, name))
+            pending_bytes += size - (offset if name == segment else 0)
+    entries, _, _ = _read_pending(APPLY_BATCH)
+    oldest_age = None
+    if entries:
+        oldest = datetime.datetime.strptime(entries[0]['sale_date'], "%Y-%m-%d %H:%M:%S")
+        oldest_age = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - oldest).total_seconds()
+    return {
+        'pending_entries': len(entries) if len(entries) < APPLY_BATCH else f"{APPLY_BATCH}+",
+        'pending_bytes': pending_bytes,
+        'oldest_pending_seconds': oldest_age,
+        'applied': _stats['applied'],
+        'rejected': _stats['rejected'],
+        'dropped': _stats['dropped'],
+        'last_apply': _stats['last_apply'],
+        'last_error': _stats['last_error'],
+    }
@@ -0,0 +1,67 @@
+"""Load-test harness for the POS API.
+
+Starts nothing itself: point it at a running `python api.py` instance, e.g.
+
+    python loadtest.py --token <token> --product-id 1 --concurrency 20 --batch-size 50 --duration 30
+
+Each worker posts /api/sales/batch requests back to back; the harness reports requests/s,
+recorded sales/s and latency percentiles. Use --batch-size 1 with --endpoint sales to
+measure single-sale requests instead.
+"""
+import argparse
+import json
+import time
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+async def worker(client, args, deadline, stats):
+    sale = {'items': [{'product_id': args.product_id, 'qty': args.qty}]}
+    if args.endpoint == "batch":
+        url = f"{args.url}/api/sales/batch"
+        body = json.dumps({'sales': [sale] * args.batch_size})
+    else:
+        url = f"{args.url}/api/sales"
+        body = json.dumps(sale)
+    headers = {'Authorization': f"Bearer {args.token}", 'Content-Type': "application/json"}
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        response = await client.fetch(url, method="POST", body=body, headers=headers, raise_error=False)
+        stats['latencies'].append(time.monotonic() - start)
+        if response.code != 200:
+            stats['errors'] += 1
+            continue
+        result = json.loads(response.body)
+        stats['sales'] += result['recorded'] if args.endpoint == "batch" else 1
+        stats['rejected'] += (args.batch_size - result['recorded']) if args.endpoint == "batch" else 0
+
+async def run(args):
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    client = tornado.httpclient.AsyncHTTPClient()
+    stats = {'sales': 0, 'rejected': 0, 'errors': 0, 'latencies': []}
+    started = time.monotonic()
+    deadline = started + args.duration
+    await tornado.gen.multi([worker(client, args, deadline, stats) for _ in range(args.concurrency)])
+    elapsed = time.monotonic() - started
+    latencies = sorted(stats['latencies']) or [0.0]
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    print(f"requests:      {len(stats['latencies'])} ({len(stats['latencies']) / elapsed:,.1f}/s), {stats['errors']} failed")
+    print(f"sales:         {stats['sales']} ({stats['sales'] / elapsed:,.1f}/s), {stats['rejected']} rejected")
+    print(f"latency (ms):  p50 {percentile(0.5):.1f}  p95 {percentile(0.95):.1f}  p99 {percentile(0.99):.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure sustained sales/s against a local RetailPulse API")
+    parser.add_argument("--url", default="http://127.0.0.1:8502")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--product-id", type=int, required=True)
+    parser.add_argument("--qty", type=int, default=1)
+    parser.add_argument("--endpoint", choices=["batch", "sales"], default="batch")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+    tornado.ioloop.IOLoop.current().run_sync(lambda: run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import threading
+import time
+import numpy as np
+from database import connect
+
+LOOKUP_TTL = 300     # seconds before a cached list is reloaded even without a local write
+SEARCH_LIMIT = 50    # matches shown in a picker
+
+# Each lookup yields (id, name, amount) rows; amount is None where it does not apply
+LOOKUP_QUERIES = {
+    "customers": "SELECT id, name, NULL FROM customers WHERE user_id = ?",
+    "suppliers": "SELECT id, name, NULL FROM suppliers WHERE user_id = ?",
+    "customer_debts": '''
+        SELECT d.id, COALESCE(c.name, ''), d.remaining_amount
+        FROM customer_debts d LEFT JOIN customers c ON c.id = d.customer_id
+        WHERE d.user_id = ? AND d.status = 'active'
+    ''',
+    "supplier_debts": '''
+        SELECT d.id, COALESCE(s.name, ''), d.remaining_amount
+        FROM supplier_debts d LEFT JOIN suppliers s ON s.id = d.supplier_id
+        WHERE d.user_id = ? AND d.status = 'active'
+    ''',
+}
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def _load(user_id, kind):
+    with connect(user_id) as conn:
+        rows = conn.execute(LOOKUP_QUERIES[kind], (user_id,)).fetchall()
+    rows.sort(key=lambda row: (row[1] or "").lower())
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    names = np.array([row[1] or "" for row in rows], dtype=object)
+    keys = np.array([name.lower() for name in names], dtype=object)
+    amounts = np.fromiter((row[2] or 0.0 for row in rows), dtype=np.float64, count=len(rows))
+    return {"ids": ids, "names": names, "keys": keys, "amounts": amounts, "loaded_at": time.monotonic()}
+
+def get_lookup(user_id, kind):
+    """Return the cached, name-sorted id/name/amount arrays for a tenant's picker list."""
+    key = (user_id, kind)
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry is None or time.monotonic() - entry["loaded_at"] > LOOKUP_TTL:
+        entry = _load(user_id, kind)
+        with _cache_lock:
+            _cache[key] = entry
+    return entry
+
+def invalidate_lookups(user_id, *kinds):
+    """Drop cached lists after a write; with no kinds every list for the tenant is dropped."""
+    with _cache_lock:
+        for key in list(_cache):
+            if key[0] == user_id and (not kinds or key[1] in kinds):
+                del _cache[key]
+
+def search_lookup(user_id, kind, query="", limit=SEARCH_LIMIT):
+    """Return up to limit (id, name, amount) tuples whose name starts with query (case-insensitive).
+
+    Names are kept sorted so a prefix match is a binary search over the array rather
+    than a scan; an empty query returns the first names alphabetically.
+    """
+    entry = get_lookup(user_id, kind)
+    prefix = query.strip().lower()
+    keys = entry["keys"]
+    start = int(np.searchsorted(keys, prefix, side="left")) if prefix else 0
+    stop = int(np.searchsorted(keys, prefix + "\uffff", side="left")) if prefix else len(keys)
+    stop = min(stop, start + limit)
+    return list(zip(entry["ids"][start:stop].tolist(), entry["names"][start:stop].tolist(),
+                    entry["amounts"][start:stop].tolist()))
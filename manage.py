@@ -0,0 +1,77 @@
+import argparse
+from database import connect, create_api_token, init_db, reconcile_balances, split_into_shards
+from forecasting import refresh_forecasts
+from history_archive import compact_history
+from journal import apply_pending, journal_lag
+from tenant_purge import purge_pending
+
+def main():
+    parser = argparse.ArgumentParser(description="RetailPulse maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split = commands.add_parser("split-shards", help="Move each tenant's rows from inventory.db into its shard file")
+    split.add_argument("--delete-source", action="store_true", help="Delete migrated rows from inventory.db")
+
+    reconcile = commands.add_parser("reconcile-balances", help="Check customer/supplier balances against the debt tables")
+    reconcile.add_argument("--fix", action="store_true", help="Rebuild balances in databases with mismatches")
+
+    token = commands.add_parser("create-api-token", help="Issue a token for the POS API (api.py)")
+    token.add_argument("username")
+    token.add_argument("--label", default="", help="Note to identify the terminal")
+
+    commands.add_parser("apply-journal", help="Replay every pending sale journal entry into the database")
+
+    commands.add_parser("compact-history", help="Archive history older than the retention window")
+
+    commands.add_parser("purge-tenants", help="Finish removing the data of deleted users")
+
+    forecasts = commands.add_parser("refresh-forecasts", help="Recompute reorder suggestions for every tenant")
+    forecasts.add_argument("--force", action="store_true", help="Recompute whole catalogs even if already done today")
+
+    args = parser.parse_args()
+    init_db()
+    if args.command == "split-shards":
+        try:
+            copied = split_into_shards(delete_source=args.delete_source,
+                                       progress=lambda fraction, message: print(f"[{fraction:5.0%}] {message}"))
+        except ValueError as e:
+            parser.exit(1, f"Migration stopped: {e}\n")
+        for table, count in copied.items():
+            print(f"{table}: {count} rows copied")
+    elif args.command == "reconcile-balances":
+        mismatches = reconcile_balances(fix=args.fix)
+        if mismatches.empty:
+            print("All balances match")
+        else:
+            print(mismatches.to_string(index=False))
+            print(f"{len(mismatches)} mismatched balances" + (" rebuilt" if args.fix else ""))
+    elif args.command == "create-api-token":
+        with connect() as conn:
+            row = conn.execute("SELECT id FROM users WHERE username = ?", (args.username,)).fetchone()
+        if row is None:
+            parser.error(f"Unknown user: {args.username}")
+        print(create_api_token(row[0], args.label))
+    elif args.command == "apply-journal":
+        total = 0
+        while True:
+            applied = apply_pending()
+            if not applied:
+                break
+            total += applied
+        print(f"Replayed {total} journal entries")
+        print(journal_lag())
+    elif args.command == "compact-history":
+        for path, moved in compact_history(progress=lambda path, moved: print(f"{path}: {moved} rows archived", end="\r")).items():
+            print(f"{path}: {moved} rows archived")
+    elif args.command == "purge-tenants":
+        purged = purge_pending(progress=lambda fraction, message: print(f"[{fraction:5.0%}] {message}", end="\r"))
+        for user_id, deleted in purged.items():
+            print(f"User {user_id}: {deleted} rows deleted")
+    elif args.command == "refresh-forecasts":
+        with connect() as conn:
+            user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        for user_id in user_ids:
+            print(f"User {user_id}: {refresh_forecasts(user_id, force=args.force)} products recomputed")
+
+if __name__ == "__main__":
+    main()
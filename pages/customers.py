@@ -1,7 +1,6 @@
-import pandas as pd
 import streamlit as st
-import sqlite3
-from database import DATABASE, get_current_user_id, log_history
+from database import connect, query_df, get_current_user_id, get_history, log_history, overdue_amounts_sql
+from lookups import invalidate_lookups, search_lookup
 
 def manage_customers():
     st.title("👤 Customer Management")
@@ -14,7 +13,7 @@ def manage_customers():
             phone = st.text_input("Phone Number")
             address = st.text_area("Address")
             if st.form_submit_button("Add Customer"):
-                with sqlite3.connect(DATABASE) as conn:
+                with connect(user_id) as conn:
                     cursor = conn.cursor()
                     cursor.execute('''
                     INSERT INTO customers (user_id, name, phone, address)
@@ -22,20 +21,21 @@ def manage_customers():
                     ''', (user_id, name, phone, address))
                     conn.commit()
                     log_history(user_id, "customer", cursor.lastrowid, "create", f"Created customer: {name}")
+                invalidate_lookups(user_id, "customers")
                 st.success("Customer added!")
 
     # Add Debt
     with st.expander("Add Customer Debt"):
+        customer_search = st.text_input("Search Customer", key="customer_debt_search")
         with st.form("new_customer_debt_form"):
-            customers = pd.read_sql("SELECT id, name FROM customers WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
-            customer_options = {row['name']: row['id'] for index, row in customers.iterrows()}
-            customer_name = st.selectbox("Select Customer", list(customer_options.keys()))
+            matches = search_lookup(user_id, "customers", customer_search)
+            selected_customer = st.selectbox("Select Customer", matches, format_func=lambda match: match[1])
             amount = st.number_input("Debt Amount", min_value=0.0)
             description = st.text_input("Description")
             due_date = st.date_input("Due Date")
-            if st.form_submit_button("Add Debt"):
-                customer_id = customer_options[customer_name]
-                with sqlite3.connect(DATABASE) as conn:
+            if st.form_submit_button("Add Debt") and selected_customer:
+                customer_id, customer_name, _ = selected_customer
+                with connect(user_id) as conn:
                     cursor = conn.cursor()
                     cursor.execute('''
                     INSERT INTO customer_debts (user_id, customer_id, initial_amount, remaining_amount, description, due_date, status)
@@ -43,11 +43,20 @@ def manage_customers():
                     ''', (user_id, customer_id, amount, amount, description, due_date))
                     conn.commit()
                     log_history(user_id, "customer_debt", cursor.lastrowid, "create", f"Added debt for {customer_name}: ₹{amount}")
+                invalidate_lookups(user_id, "customer_debts")
                 st.success("Debt added!")
 
     # View Customers
     st.subheader("Customer List")
-    customers = pd.read_sql("SELECT * FROM customers WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
+    customers = query_df(user_id, f'''
+    SELECT c.id, c.name, c.phone, c.address, c.created_date, COALESCE(b.open_amount, 0) AS balance, COALESCE(o.overdue_amount, 0) AS overdue,
+           COALESCE(b.open_debts, 0) AS open_debts, b.last_payment_date
+    FROM customers c
+    LEFT JOIN counterparty_balances b
+        ON b.user_id = c.user_id AND b.counterparty_type = 'customer' AND b.counterparty_id = c.id
+    LEFT JOIN ({overdue_amounts_sql("customer")}) o ON o.counterparty_id = c.id
+    WHERE c.user_id=?
+    ''', (user_id, user_id))
     if not customers.empty:
         st.dataframe(customers)
     else:
@@ -55,8 +64,7 @@ def manage_customers():
     
     # Customer History
     st.subheader("Customer History")
-    customer_history = pd.read_sql("SELECT * FROM history WHERE user_id=? AND entity_type IN ('customer', 'customer_debt') ORDER BY timestamp DESC", 
-                                 sqlite3.connect(DATABASE), params=(user_id,))
+    customer_history = get_history(user_id, ['customer', 'customer_debt'])
     if not customer_history.empty:
         st.dataframe(customer_history)
         if st.button("Export Customer History"):
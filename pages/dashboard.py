@@ -1,43 +1,110 @@
-import sqlite3
+import datetime
+import time
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from database import DATABASE, get_current_user_id, get_products, log_history
+from database import connect, get_current_user_id, log_history
+
+REFRESH_SECONDS = 5        # live mode tick
+FULL_RELOAD_SECONDS = 600  # resync from scratch now and then so edits to existing debts show up
+TREND_DAYS = 30
+
+def _max_id(conn, table):
+    return conn.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0] or 0
+
+def _debt_marks(conn):
+    """Highest debt and payment ids; debt totals are only re-read when one of these moves."""
+    return tuple(_max_id(conn, table)
+                 for table in ("customer_debts", "supplier_debts", "customer_debt_payments", "supplier_debt_payments"))
+
+def _active_debts(conn, user_id):
+    return conn.execute("SELECT SUM(open_amount) FROM counterparty_balances WHERE user_id = ?", (user_id,)).fetchone()[0] or 0
+
+def _trend_start():
+    return (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=TREND_DAYS)).isoformat()
+
+def _load_dashboard(user_id):
+    """Compute every tile from scratch and record the watermarks they are current to."""
+    with connect(user_id) as conn:
+        sale_id = _max_id(conn, "sales")
+        total_sales = conn.execute("SELECT SUM(total_price) FROM sales WHERE user_id = ? AND id <= ?",
+                                   (user_id, sale_id)).fetchone()[0] or 0
+        trend = dict(conn.execute('''
+        SELECT DATE(sale_date), SUM(total_price) FROM sales
+        WHERE user_id = ? AND id <= ? AND sale_date >= ?
+        GROUP BY DATE(sale_date)
+        ''', (user_id, sale_id, _trend_start())).fetchall())
+        stock = conn.execute("SELECT quantity, low_stock_items, version FROM stock_totals WHERE user_id = ?",
+                             (user_id,)).fetchone() or (0, 0, 0)
+        debt_marks = _debt_marks(conn)
+        active_debts = _active_debts(conn, user_id)
+    return {
+        'user_id': user_id, 'loaded_at': time.monotonic(),
+        'sale_id': sale_id, 'stock_version': stock[2], 'debt_marks': debt_marks,
+        'total_sales': total_sales, 'total_stock': stock[0], 'low_stock': stock[1],
+        'active_debts': active_debts, 'trend': trend,
+    }
+
+def _apply_deltas(state):
+    """Fold rows newer than the watermarks into the cached tiles."""
+    user_id = state['user_id']
+    with connect(user_id) as conn:
+        sale_id = _max_id(conn, "sales")
+        if sale_id > state['sale_id']:
+            new_sales = conn.execute('''
+            SELECT DATE(sale_date), SUM(total_price) FROM sales
+            WHERE id > ? AND id <= ? AND user_id = ?
+            GROUP BY DATE(sale_date)
+            ''', (state['sale_id'], sale_id, user_id)).fetchall()
+            for day, total in new_sales:
+                state['total_sales'] += total or 0
+                state['trend'][day] = state['trend'].get(day, 0) + (total or 0)
+            state['sale_id'] = sale_id
+        stock = conn.execute("SELECT quantity, low_stock_items, version FROM stock_totals WHERE user_id = ?",
+                             (user_id,)).fetchone()
+        if stock and stock[2] != state['stock_version']:
+            state['total_stock'], state['low_stock'], state['stock_version'] = stock
+        debt_marks = _debt_marks(conn)
+        if debt_marks != state['debt_marks']:
+            state['debt_marks'] = debt_marks
+            state['active_debts'] = _active_debts(conn, user_id)
+    start = _trend_start()
+    for day in [day for day in state['trend'] if day < start]:
+        del state['trend'][day]
+
+def _render_tiles(user_id):
+    state = st.session_state.get('dashboard')
+    if (state is None or state['user_id'] != user_id
+            or time.monotonic() - state['loaded_at'] > FULL_RELOAD_SECONDS):
+        state = st.session_state.dashboard = _load_dashboard(user_id)
+    else:
+        _apply_deltas(state)
 
-def show_dashboard():
-    st.title("📊 Shop Dashboard")
-    user_id = get_current_user_id()
-    
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        total_stock = get_products(user_id)['quantity'].sum()
-        st.metric("Total Stock Value", f"₹{total_stock:,.2f}")
+        st.metric("Total Stock Value", f"₹{state['total_stock']:,.2f}")
     with col2:
-        low_stock = get_products(user_id)[get_products(user_id)['quantity'] <= get_products(user_id)['alert_threshold']]
-        st.metric("Low Stock Items", len(low_stock), delta_color="inverse")
+        st.metric("Low Stock Items", state['low_stock'], delta_color="inverse")
     with col3:
-        total_sales = pd.read_sql("SELECT SUM(total_price) FROM sales WHERE user_id=?", 
-                                 sqlite3.connect(DATABASE), params=(user_id,)).iloc[0,0] or 0
-        st.metric("Total Sales", f"₹{total_sales:,.2f}")
+        st.metric("Total Sales", f"₹{state['total_sales']:,.2f}")
     with col4:
-        active_debts = (pd.read_sql("SELECT SUM(remaining_amount) FROM customer_debts WHERE status='active' AND user_id=?", 
-                                  sqlite3.connect(DATABASE), params=(user_id,)).iloc[0,0] or 0) + \
-                       (pd.read_sql("SELECT SUM(remaining_amount) FROM supplier_debts WHERE status='active' AND user_id=?", 
-                                  sqlite3.connect(DATABASE), params=(user_id,)).iloc[0,0] or 0)
-        st.metric("Active Debts", f"₹{active_debts:,.2f}")
-    
+        st.metric("Active Debts", f"₹{state['active_debts']:,.2f}")
+
     st.subheader("Sales Trend (Last 30 Days)")
-    sales_data = pd.read_sql('''
-    SELECT DATE(sale_date) as date, SUM(total_price) as total 
-    FROM sales 
-    WHERE sale_date >= DATE('now', '-30 days') AND user_id=?
-    GROUP BY DATE(sale_date)
-    ''', sqlite3.connect(DATABASE), params=(user_id,))
-    if not sales_data.empty:
+    if state['trend']:
+        sales_data = pd.DataFrame(sorted(state['trend'].items()), columns=['date', 'total'])
         fig = px.line(sales_data, x='date', y='total', labels={'total': 'Daily Sales'}, markers=True)
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("No sales data available")
-    
+
+def show_dashboard():
+    st.title("📊 Shop Dashboard")
+    user_id = get_current_user_id()
+
+    # Live mode reruns only the tiles on a timer; each tick reads rows past the stored watermarks
+    live = st.toggle("Live mode", value=True, help=f"Refresh every {REFRESH_SECONDS} seconds")
+    st.fragment(_render_tiles, run_every=REFRESH_SECONDS if live else None)(user_id)
+
     # Log dashboard view (optional, for history tracking)
-    log_history(user_id, "dashboard", None, "view", "Viewed dashboard")
\ No newline at end of file
+    log_history(user_id, "dashboard", None, "view", "Viewed dashboard")
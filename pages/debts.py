@@ -1,7 +1,8 @@
+import sqlite3
 import streamlit as st
 import pandas as pd
-import sqlite3
-from database import DATABASE, get_current_user_id, log_history
+from database import query_df, get_current_user_id, get_debt_remaining, log_history, record_debt_payment
+from lookups import invalidate_lookups, search_lookup
 
 def manage_debts():
     st.title("📝 Debt Management")
@@ -11,80 +12,68 @@ def manage_debts():
     
     with tab1:
         st.subheader("Customer Debts (To Receive)")
-        debts = pd.read_sql("SELECT * FROM customer_debts WHERE status='active' AND user_id=?", 
-                           sqlite3.connect(DATABASE), params=(user_id,))
+        debts = query_df(user_id, "SELECT id, customer_id, initial_amount, remaining_amount, description, due_date, created_date FROM customer_debts WHERE status='active' AND user_id=?", (user_id,))
         if not debts.empty:
             st.dataframe(debts)
         else:
             st.info("No active customer debts")
         
+        debt_search = st.text_input("Search by Customer", key="customer_payment_search")
         with st.form("customer_payment_form"):
-            active_debts = pd.read_sql("SELECT id, customer_id, remaining_amount FROM customer_debts WHERE status='active' AND user_id=?", 
-                                      sqlite3.connect(DATABASE), params=(user_id,))
-            if not active_debts.empty:
-                debt_options = {f"Debt ID {row['id']} (₹{row['remaining_amount']})": row['id'] for index, row in active_debts.iterrows()}
-                selected_debt = st.selectbox("Select Debt to Pay", options=list(debt_options.keys()))
-                debt_id = debt_options[selected_debt]
-                max_amount = float(active_debts[active_debts['id'] == debt_id]['remaining_amount'].iloc[0])
+            matches = search_lookup(user_id, "customer_debts", debt_search)
+            if matches:
+                selected_debt = st.selectbox("Select Debt to Pay", matches,
+                                             format_func=lambda match: f"Debt ID {match[0]} - {match[1]} (₹{match[2]})")
+                # The lookup list may be minutes old, so the limit comes from the debt itself
+                debt_id = selected_debt[0]
+                max_amount = get_debt_remaining(user_id, "customer", debt_id)
                 amount = st.number_input("Payment Amount", min_value=0.0, max_value=max_amount)
                 payment_method = st.selectbox("Payment Method", ["Cash", "Card", "Online"])
                 if st.form_submit_button("Record Payment"):
-                    with sqlite3.connect(DATABASE) as conn:
-                        conn.execute('''
-                        INSERT INTO customer_debt_payments (user_id, debt_id, amount, payment_method)
-                        VALUES (?, ?, ?, ?)
-                        ''', (user_id, debt_id, amount, payment_method))
-                        conn.execute('''
-                        UPDATE customer_debts SET remaining_amount = remaining_amount - ? WHERE id = ? AND user_id = ?
-                        ''', (amount, debt_id, user_id))
-                        remaining = pd.read_sql("SELECT remaining_amount FROM customer_debts WHERE id=? AND user_id=?", 
-                                               conn, params=(debt_id, user_id)).iloc[0,0]
-                        if remaining <= 0:
-                            conn.execute("UPDATE customer_debts SET status = 'paid' WHERE id = ? AND user_id = ?", (debt_id, user_id))
-                        conn.commit()
-                        log_history(user_id, "customer_debt", debt_id, "payment", f"Paid ₹{amount} on debt {debt_id}")
-                    st.success("Payment recorded!")
+                    try:
+                        record_debt_payment(user_id, "customer", debt_id, amount, payment_method)
+                    except sqlite3.IntegrityError:
+                        st.error("Payment not recorded: it is more than the debt's remaining amount")
+                    except ValueError as e:
+                        st.error(f"Payment not recorded: {str(e)}")
+                    else:
+                        st.success("Payment recorded!")
+                    invalidate_lookups(user_id, "customer_debts")
     
     with tab2:
         st.subheader("Supplier Debts (To Pay)")
-        debts = pd.read_sql("SELECT * FROM supplier_debts WHERE status='active' AND user_id=?", 
-                           sqlite3.connect(DATABASE), params=(user_id,))
+        debts = query_df(user_id, "SELECT id, supplier_id, initial_amount, remaining_amount, description, due_date, created_date FROM supplier_debts WHERE status='active' AND user_id=?", (user_id,))
         if not debts.empty:
             st.dataframe(debts)
         else:
             st.info("No active supplier debts")
         
+        debt_search = st.text_input("Search by Supplier", key="supplier_payment_search")
         with st.form("supplier_payment_form"):
-            active_debts = pd.read_sql("SELECT id, supplier_id, remaining_amount FROM supplier_debts WHERE status='active' AND user_id=?", 
-                                      sqlite3.connect(DATABASE), params=(user_id,))
-            if not active_debts.empty:
-                debt_options = {f"Debt ID {row['id']} (₹{row['remaining_amount']})": row['id'] for index, row in active_debts.iterrows()}
-                selected_debt = st.selectbox("Select Debt to Pay", options=list(debt_options.keys()))
-                debt_id = debt_options[selected_debt]
-                max_amount = float(active_debts[active_debts['id'] == debt_id]['remaining_amount'].iloc[0])
+            matches = search_lookup(user_id, "supplier_debts", debt_search)
+            if matches:
+                selected_debt = st.selectbox("Select Debt to Pay", matches,
+                                             format_func=lambda match: f"Debt ID {match[0]} - {match[1]} (₹{match[2]})")
+                # The lookup list may be minutes old, so the limit comes from the debt itself
+                debt_id = selected_debt[0]
+                max_amount = get_debt_remaining(user_id, "supplier", debt_id)
                 amount = st.number_input("Payment Amount", min_value=0.0, max_value=max_amount)
                 payment_method = st.selectbox("Payment Method", ["Cash", "Card", "Online"])
                 if st.form_submit_button("Record Payment"):
-                    with sqlite3.connect(DATABASE) as conn:
-                        conn.execute('''
-                        INSERT INTO supplier_debt_payments (user_id, debt_id, amount, payment_method)
-                        VALUES (?, ?, ?, ?)
-                        ''', (user_id, debt_id, amount, payment_method))
-                        conn.execute('''
-                        UPDATE supplier_debts SET remaining_amount = remaining_amount - ? WHERE id = ? AND user_id = ?
-                        ''', (amount, debt_id, user_id))
-                        remaining = pd.read_sql("SELECT remaining_amount FROM supplier_debts WHERE id=? AND user_id=?", 
-                                               conn, params=(debt_id, user_id)).iloc[0,0]
-                        if remaining <= 0:
-                            conn.execute("UPDATE supplier_debts SET status = 'paid' WHERE id = ? AND user_id = ?", (debt_id, user_id))
-                        conn.commit()
-                        log_history(user_id, "supplier_debt", debt_id, "payment", f"Paid ₹{amount} on debt {debt_id}")
-                    st.success("Payment recorded!")
+                    try:
+                        record_debt_payment(user_id, "supplier", debt_id, amount, payment_method)
+                    except sqlite3.IntegrityError:
+                        st.error("Payment not recorded: it is more than the debt's remaining amount")
+                    except ValueError as e:
+                        st.error(f"Payment not recorded: {str(e)}")
+                    else:
+                        st.success("Payment recorded!")
+                    invalidate_lookups(user_id, "supplier_debts")
     
     # Debt History
     st.subheader("Debt History")
-    customer_debt_payments = pd.read_sql("SELECT * FROM customer_debt_payments WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
-    supplier_debt_payments = pd.read_sql("SELECT * FROM supplier_debt_payments WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
+    customer_debt_payments = query_df(user_id, "SELECT id, debt_id, amount, payment_date, payment_method FROM customer_debt_payments WHERE user_id=?", (user_id,))
+    supplier_debt_payments = query_df(user_id, "SELECT id, debt_id, amount, payment_date, payment_method FROM supplier_debt_payments WHERE user_id=?", (user_id,))
     if not customer_debt_payments.empty or not supplier_debt_payments.empty:
         debt_history = pd.concat([customer_debt_payments, supplier_debt_payments], ignore_index=True).sort_values('payment_date', ascending=False)
         st.dataframe(debt_history)
@@ -1,7 +1,5 @@
-import sqlite3
 import streamlit as st
-import pandas as pd
-from database import DATABASE, get_current_user_id
+from database import HISTORY_RETENTION_DAYS, query_df, get_current_user_id, get_history
 
 def manage_history():
     st.title("⏳ History")
@@ -11,18 +9,23 @@ def manage_history():
     entity_types = ["All", "product", "sale", "customer", "customer_debt", "supplier", "supplier_debt", "report"]
     entity_filter = st.selectbox("Filter by Entity", entity_types)
     
-    query = "SELECT * FROM history WHERE user_id=? "
-    params = [user_id]
-    if entity_filter != "All":
-        query += "AND entity_type=?"
-        params.append(entity_filter)
-    query += "ORDER BY timestamp DESC"
-    
-    history = pd.read_sql(query, sqlite3.connect(DATABASE), params=params)
+    st.caption(f"Showing the last {HISTORY_RETENTION_DAYS} days; older events are archived.")
+    history = get_history(user_id, None if entity_filter == "All" else [entity_filter])
     if not history.empty:
         st.dataframe(history)
         if st.button("Export History"):
             csv = history.to_csv(index=False)
             st.download_button(label="Download CSV", data=csv, file_name="history.csv", mime="text/csv")
     else:
-        st.info("No history records found.")
\ No newline at end of file
+        st.info("No history records found.")
+    
+    # Page views and report runs are kept as daily counts
+    st.subheader("Activity Counts")
+    counters = query_df(user_id, '''
+    SELECT day, entity_type, action, detail, count FROM history_counters
+    WHERE user_id = ? ORDER BY day DESC, count DESC
+    ''', (user_id,))
+    if not counters.empty:
+        st.dataframe(counters)
+    else:
+        st.info("No activity recorded yet.")
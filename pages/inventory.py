@@ -1,8 +1,10 @@
 import streamlit as st
-from st_aggrid import AgGrid, GridOptionsBuilder, ColumnsAutoSizeMode
+from st_aggrid import AgGrid, GridOptionsBuilder, ColumnsAutoSizeMode, GridUpdateMode
 import pandas as pd
 import sqlite3
-from database import DATABASE, get_current_user_id, get_products, log_history
+from database import (PRODUCT_SORT_COLUMNS, connect, get_current_user_id, get_low_stock, get_products,
+                      get_products_page, import_products, log_history, set_stock, set_stock_levels)
+from forecasting import apply_suggested_thresholds, get_reorder_suggestions, start_forecast_refresh
 from io import BytesIO
 import barcode
 from barcode.writer import ImageWriter
@@ -33,14 +35,13 @@ def manage_inventory():
         with col1:
             st.subheader("CSV Import")
             uploaded_file = st.file_uploader("Upload products CSV", type="csv")
-            if uploaded_file:
+            if uploaded_file and st.button("Import Products"):
                 try:
                     df = pd.read_csv(uploaded_file)
-                    df['user_id'] = user_id
-                    with sqlite3.connect(DATABASE) as conn:
-                        df.to_sql('products', conn, if_exists='append', index=False)
-                    log_history(user_id, "product", None, "bulk_import", f"Imported {len(df)} products")
-                    st.success(f"Imported {len(df)} products!")
+                    added = import_products(user_id, df)
+                    log_history(user_id, "product", None, "bulk_import", f"Imported {added} products")
+                    skipped = f" ({len(df) - added} already existed)" if added < len(df) else ""
+                    st.success(f"Imported {added} products!{skipped}")
                 except Exception as e:
                     st.error(f"Import error: {str(e)}")
         with col2:
@@ -53,40 +54,86 @@ def manage_inventory():
 
     # Real-time Stock Alerts
     with st.expander("Stock Alerts"):
-        products = get_products(user_id)
-        low_stock = products[products['quantity'] <= products['alert_threshold']]
-        if not low_stock.empty:
-            st.warning(f"🚨 {len(low_stock)} items need restocking!")
-            st.dataframe(low_stock[['name', 'quantity', 'alert_threshold']], use_container_width=True)
+        low_stock, low_count = get_low_stock(user_id)
+        if low_count:
+            st.warning(f"🚨 {low_count} items need restocking!")
+            st.dataframe(low_stock, use_container_width=True)
         else:
             st.success("All stock levels are satisfactory")
+        
+        st.markdown("**Forecast Reorder Points**")
+        # Forecasts are recomputed in the background; the page only reads the stored suggestions
+        start_forecast_refresh(user_id)
+        to_order = get_reorder_suggestions(user_id, reorder_only=True)
+        if not to_order.empty:
+            st.warning(f"📈 {len(to_order)} items will run out within the lead time at current sales rates")
+            st.dataframe(to_order[['name', 'quantity', 'daily_velocity', 'reorder_point', 'alert_threshold', 'order_quantity']]
+                         .sort_values('order_quantity', ascending=False), use_container_width=True)
+        else:
+            st.info("No items are forecast to need reordering")
+        if st.button("Apply Suggested Thresholds"):
+            updated = apply_suggested_thresholds(user_id)
+            log_history(user_id, "product", None, "update", f"Applied forecast alert thresholds to {updated} products")
+            st.success(f"Updated alert thresholds for {updated} products!")
+            st.rerun()
 
     # Product List with Enhanced UX
+    # Filtering, sorting and paging run in SQL so only the visible page is sent to the grid
     st.subheader("Product List")
-    products = get_products(user_id)
-    if search_term:
-        products = products[products['name'].str.contains(search_term, case=False, na=False)]
-    if category_filter:
-        products = products[products['category'].str.contains(category_filter, case=False, na=False)]
+    col1, col2, col3 = st.columns([2, 1, 1])
+    with col1:
+        sort_by = st.selectbox("Sort by", PRODUCT_SORT_COLUMNS)
+    with col2:
+        descending = st.toggle("Descending")
+    with col3:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1)
+    view = (search_term, category_filter, sort_by, descending, page_size)
+    if st.session_state.get("inventory_view") != view:
+        st.session_state.inventory_view = view
+        st.session_state.inventory_page = 1
+    page = st.session_state.get("inventory_page", 1)
+    products, total = get_products_page(user_id, search_term, category_filter, sort_by, descending, page, page_size)
+    pages = max((total + page_size - 1) // page_size, 1)
+    if page > pages:  # products were deleted from the last page
+        st.session_state.inventory_page = pages
+        st.rerun()
     
-    if not products.empty:
+    if total:
+        st.number_input(f"Page (of {pages:,}, {total:,} products)", min_value=1, max_value=pages, key="inventory_page")
+
         gb = GridOptionsBuilder.from_dataframe(products)
-        gb.configure_pagination(paginationPageSize=10)
         gb.configure_side_bar()
         gb.configure_selection('single', use_checkbox=True)
         gb.configure_column("quantity", editable=True, headerName="Stock")
         grid_options = gb.build()
         
+        # Each cell edit reruns the page; pending edits are only written, in one transaction, by "Save Stock Edits"
         grid_response = AgGrid(
             products,
             gridOptions=grid_options,
             columns_auto_size_mode=ColumnsAutoSizeMode.FIT_CONTENTS,
             theme="streamlit",
-            update_mode='MODEL_CHANGED',
-            height=400
+            update_mode=GridUpdateMode.VALUE_CHANGED | GridUpdateMode.SELECTION_CHANGED,
+            height=400,
+            key=f"products_grid_{view}_{page}"
         )
         
+        edited = grid_response['data']
+        if edited is not None and len(edited) == len(products):
+            edited_qty = pd.to_numeric(edited['quantity'], errors='coerce').to_numpy()
+            changed = (edited['id'].to_numpy() == products['id'].to_numpy()) & (edited_qty != products['quantity'].to_numpy())
+            changes = {int(product_id): int(qty) for product_id, qty in zip(products['id'][changed], edited_qty[changed])
+                       if qty == qty and qty >= 0}
+            if changes:
+                st.info(f"{len(changes)} stock edits not saved yet")
+                if st.button("💾 Save Stock Edits"):
+                    set_stock_levels(user_id, changes)
+                    st.success(f"Updated stock for {len(changes)} products!")
+                    st.rerun()
+
         selected = grid_response['selected_rows']
+        if isinstance(selected, pd.DataFrame):
+            selected = selected.to_dict('records')
         if isinstance(selected, list) and selected:
             product = selected[0]
             with st.container(border=True):
@@ -96,10 +143,7 @@ def manage_inventory():
                     with st.form(f"update_{product['id']}"):
                         new_qty = st.number_input("Update Stock", value=int(product['quantity']), min_value=0)
                         if st.form_submit_button("Update"):
-                            with sqlite3.connect(DATABASE) as conn:
-                                conn.execute("UPDATE products SET quantity = ?, last_restock = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?", 
-                                            (new_qty, product['id'], user_id))
-                            log_history(user_id, "product", product['id'], "update", f"Updated quantity to {new_qty}")
+                            set_stock(user_id, product['id'], new_qty)
                             st.success("Stock updated!")
                             st.rerun()
                 with col2:
@@ -108,7 +152,7 @@ def manage_inventory():
                         st.image(barcode_buffer)
                 with col3:
                     if st.button("🗑️ Delete", key=f"delete_{product['id']}"):
-                        with sqlite3.connect(DATABASE) as conn:
+                        with connect(user_id) as conn:
                             conn.execute("DELETE FROM products WHERE id = ? AND user_id = ?", (product['id'], user_id))
                         log_history(user_id, "product", product['id'], "delete", f"Deleted product: {product['name']}")
                         st.success("Product deleted!")
@@ -134,7 +178,7 @@ def manage_inventory():
                     st.error("Product name is required!")
                 else:
                     try:
-                        with sqlite3.connect(DATABASE) as conn:
+                        with connect(user_id) as conn:
                             cursor = conn.cursor()
                             cursor.execute('''
                                 INSERT INTO products (user_id, name, category, quantity, unit_price, alert_threshold)
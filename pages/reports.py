@@ -1,9 +1,7 @@
-import sqlite3
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 import datetime
-from database import DATABASE, get_current_user_id, get_products, log_history
+from database import query_df, get_current_user_id, get_products, log_history
 
 def generate_reports():
     st.title("📈 Reporting & Analytics")
@@ -18,13 +16,13 @@ def generate_reports():
     
     if st.button("Generate Report"):
         if report_type == "Sales Report":
-            sales_data = pd.read_sql(f'''
+            sales_data = query_df(user_id, f'''
             SELECT products.name, SUM(sales.quantity_sold) as total_quantity, SUM(sales.total_price) as total_sales
             FROM sales
             JOIN products ON sales.product_id = products.id
             WHERE DATE(sales.sale_date) BETWEEN '{start_date}' AND '{end_date}' AND sales.user_id = ?
             GROUP BY products.name
-            ''', sqlite3.connect(DATABASE), params=(user_id,))
+            ''', (user_id,))
             st.subheader("Sales Report")
             if not sales_data.empty:
                 fig = px.bar(sales_data, x='name', y='total_sales', title="Product Sales Performance")
@@ -35,7 +33,7 @@ def generate_reports():
             log_history(user_id, "report", None, "generate", f"Generated {report_type}")
         
         elif report_type == "Inventory Report":
-            inventory = get_products(user_id)
+            inventory = get_products(user_id, ['category', 'quantity'])
             st.subheader("Inventory Status")
             col1, col2 = st.columns(2)
             with col1:
@@ -47,12 +45,12 @@ def generate_reports():
             log_history(user_id, "report", None, "generate", f"Generated {report_type}")
         
         elif report_type == "Customer Debt Report":
-            debts = pd.read_sql(f'''
+            debts = query_df(user_id, f'''
             SELECT c.name, cd.initial_amount, cd.remaining_amount, cd.due_date
             FROM customer_debts cd
             JOIN customers c ON cd.customer_id = c.id
             WHERE cd.status = 'active' AND cd.user_id = ? AND cd.due_date BETWEEN '{start_date}' AND '{end_date}'
-            ''', sqlite3.connect(DATABASE), params=(user_id,))
+            ''', (user_id,))
             st.subheader("Active Customer Debts Report")
             if not debts.empty:
                 st.dataframe(debts)
@@ -63,12 +61,12 @@ def generate_reports():
             log_history(user_id, "report", None, "generate", f"Generated {report_type}")
         
         elif report_type == "Supplier Debt Report":
-            debts = pd.read_sql(f'''
+            debts = query_df(user_id, f'''
             SELECT s.name, sd.initial_amount, sd.remaining_amount, sd.due_date
             FROM supplier_debts sd
             JOIN suppliers s ON sd.supplier_id = s.id
             WHERE sd.status = 'active' AND sd.user_id = ? AND sd.due_date BETWEEN '{start_date}' AND '{end_date}'
-            ''', sqlite3.connect(DATABASE), params=(user_id,))
+            ''', (user_id,))
             st.subheader("Active Supplier Debts Report")
             if not debts.empty:
                 st.dataframe(debts)
@@ -1,16 +1,15 @@
-import pandas as pd
 import streamlit as st
-import sqlite3
 import datetime
-from database import DATABASE, get_current_user_id, get_products, log_history
+from database import query_df, get_current_user_id, get_products, log_history, record_sales
+from journal import JOURNAL_ENABLED, append_sale, journal_lag, start_applier
 
-def generate_receipt(sale_items, total, customer_name):
+def generate_receipt(user_id, sale_items, total, customer_name):
     receipt = f"Shop Manager Pro Receipt\nDate: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
     if customer_name:
         receipt += f"Customer: {customer_name}\n"
     receipt += "-" * 40 + "\nItem          Qty    Price    Total\n"
     for item in sale_items:
-        name = pd.read_sql("SELECT name FROM products WHERE id=?", sqlite3.connect(DATABASE), params=(item['product_id'],)).iloc[0]['name']
+        name = query_df(user_id, "SELECT name FROM products WHERE id=?", (item['product_id'],)).iloc[0]['name']
         receipt += f"{name:<12} {item['qty']:<6} {item['price']:<8.2f} {item['total']:.2f}\n"
     receipt += "-" * 40 + "\nTotal Amount: ₹{total:.2f}\n"
     return receipt
@@ -19,7 +18,7 @@ def manage_sales():
     st.title("💵 Sales Processing")
     user_id = get_current_user_id()
     
-    products = get_products(user_id)
+    products = get_products(user_id, ['id', 'name', 'unit_price', 'quantity'])
     if products.empty:
         st.warning("No products available for sale")
         return
@@ -54,29 +53,35 @@ def manage_sales():
             with cols[1]:
                 if st.button("💳 Process Sale", type="primary"):
                     try:
-                        with sqlite3.connect(DATABASE) as conn:
-                            cursor = conn.cursor()
-                            for item in sale_items:
-                                cursor.execute('''
-                                    UPDATE products SET quantity = quantity - ? WHERE id = ? AND user_id = ?
-                                ''', (item['qty'], item['product_id'], user_id))
-                                cursor.execute('''
-                                    INSERT INTO sales (user_id, product_id, quantity_sold, total_price)
-                                    VALUES (?, ?, ?, ?)
-                                ''', (user_id, item['product_id'], item['qty'], item['total']))
-                            conn.commit()
-                            sale_id = cursor.lastrowid
-                            log_history(user_id, "sale", sale_id, "create", f"Sale: {total} for {len(sale_items)} items")
+                        if JOURNAL_ENABLED:
+                            append_sale(user_id, sale_items)
+                        else:
+                            result = record_sales(user_id, [sale_items])[0]
+                            if not result['ok']:
+                                for line in result.get('short', []):
+                                    st.warning(f"Only {line['available']} of {line['name']} left (requested {line['requested']})")
+                                raise ValueError(result['error'])
                         st.success("Sale processed!")
                         st.balloons()
-                        receipt = generate_receipt(sale_items, total, customer_name)
+                        receipt = generate_receipt(user_id, sale_items, total, customer_name)
                         st.download_button(label="📄 Download Receipt", data=receipt, file_name=f"receipt_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.txt", mime="text/plain")
                     except Exception as e:
                         st.error(f"Transaction failed: {str(e)}")
     
+    if JOURNAL_ENABLED:
+        start_applier()
+        with st.expander("Sale Journal"):
+            lag = journal_lag()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Pending Sales", lag['pending_entries'])
+            col2.metric("Oldest Pending", f"{lag['oldest_pending_seconds'] or 0:.1f}s")
+            col3.metric("Rejected on Replay", lag['rejected'])
+            if lag['last_error']:
+                st.warning(f"Last applier error: {lag['last_error']}")
+    
     # Sales/Transaction History
     st.subheader("Sales History")
-    sales = pd.read_sql("SELECT * FROM sales WHERE user_id=? ORDER BY sale_date DESC", sqlite3.connect(DATABASE), params=(user_id,))
+    sales = query_df(user_id, "SELECT id, product_id, quantity_sold, total_price, sale_date FROM sales WHERE user_id=? ORDER BY sale_date DESC", (user_id,))
     if not sales.empty:
         st.dataframe(sales)
         if st.button("Export Sales History"):
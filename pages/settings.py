@@ -1,8 +1,11 @@
 import hashlib
+import os
+import tempfile
 import streamlit as st
-import pandas as pd
 import sqlite3
-from database import DATABASE, get_current_user_id, log_history
+from database import assign_shard, backup_database, connect, fan_out, query_df, get_current_user_id, log_history, restore_database
+from lookups import invalidate_lookups
+from tenant_purge import purge_status, request_purge, start_purger
 
 def manage_settings():
     st.title("⚙️ Settings")
@@ -16,7 +19,10 @@ def manage_settings():
     
     with tab1:
         st.subheader("User Accounts")
-        users = pd.read_sql("SELECT id, username, role FROM users", sqlite3.connect(DATABASE))
+        users = query_df(None, "SELECT id, username, role FROM users")
+        usage = fan_out("SELECT user_id AS id, COUNT(*) AS products FROM products GROUP BY user_id", tenant_column='id')
+        if not usage.empty:
+            users = users.merge(usage, on='id', how='left')
         st.dataframe(users)
         
         with st.expander("Create New User"):
@@ -26,13 +32,13 @@ def manage_settings():
                 role = st.selectbox("Role", ["admin", "staff"])
                 if st.form_submit_button("Create User"):
                     try:
-                        with sqlite3.connect(DATABASE) as conn:
-                            conn.execute('''
+                        with connect() as conn:
+                            cursor = conn.execute('''
                             INSERT INTO users (username, password, role)
                             VALUES (?, ?, ?)
                             ''', (username, hashlib.sha256(password.encode()).hexdigest(), role))
-                            conn.commit()
-                            log_history(user_id, "user", conn.lastrowid, "create", f"Created user: {username}")
+                            assign_shard(conn, cursor.lastrowid)
+                        log_history(user_id, "user", cursor.lastrowid, "create", f"Created user: {username}")
                         st.success("User created!")
                         st.rerun()
                     except sqlite3.IntegrityError:
@@ -41,26 +47,51 @@ def manage_settings():
         with st.expander("Delete User"):
             user_id_to_delete = st.number_input("User ID to delete", min_value=1)
             if st.button("Delete User"):
-                with sqlite3.connect(DATABASE) as conn:
-                    conn.execute("DELETE FROM users WHERE id = ?", (user_id_to_delete,))
-                    conn.commit()
+                if user_id_to_delete == user_id:
+                    st.error("You cannot delete your own account!")
+                elif not request_purge(user_id_to_delete):
+                    st.error("No user with that ID")
+                else:
+                    invalidate_lookups(user_id_to_delete)
+                    start_purger()
                     log_history(user_id, "user", user_id_to_delete, "delete", f"Deleted user ID: {user_id_to_delete}")
-                st.success("User deleted!")
-                st.rerun()
+                    st.success("User deleted! Their data is being removed in the background.")
+                    st.rerun()
+            # Purges run in the background and resume after a restart
+            purges = purge_status()
+            if not purges.empty:
+                if purges['finished_at'].isna().any():
+                    start_purger()
+                st.markdown("**Data Removal**")
+                st.dataframe(purges)
     
     with tab2:
         st.subheader("Database Management")
-        st.download_button(
-            label="Backup Database",
-            data=open(DATABASE, "rb").read(),
-            file_name="inventory_backup.db",
-            mime="application/octet-stream"
-        )
+        # Backups are a zip of the central file and every shard, snapshotted while the app runs
+        if st.button("Backup Database"):
+            fd, backup_path = tempfile.mkstemp(suffix=".zip")
+            os.close(fd)
+            try:
+                backup_database(backup_path)
+                with open(backup_path, "rb") as f:
+                    backup = f.read()
+            finally:
+                os.remove(backup_path)
+            st.download_button(
+                label="Download Backup",
+                data=backup,
+                file_name="inventory_backup.zip",
+                mime="application/zip"
+            )
         st.markdown("---")
-        uploaded_db = st.file_uploader("Restore Database", type="db")
+        uploaded_db = st.file_uploader("Restore Database", type=["zip", "db"])
         if uploaded_db and st.button("Restore Backup"):
-            with open(DATABASE, "wb") as f:
-                f.write(uploaded_db.getvalue())
-            st.success("Database restored!")
-            log_history(user_id, "database", None, "restore", "Restored database backup")
-            st.rerun()
\ No newline at end of file
+            progress_bar = st.progress(0.0, text="Starting restore...")
+            try:
+                restore_database(uploaded_db, progress=lambda fraction, message: progress_bar.progress(fraction, text=message))
+            except ValueError as e:
+                st.error(f"Backup rejected: {str(e)}")
+            else:
+                st.success("Database restored!")
+                log_history(user_id, "database", None, "restore", "Restored database backup")
+                st.rerun()
\ No newline at end of file
@@ -1,7 +1,7 @@
-import pandas as pd
 import streamlit as st
 import sqlite3
-from database import DATABASE, get_current_user_id, log_history
+from database import connect, query_df, get_current_user_id, get_history, log_history, overdue_amounts_sql
+from lookups import invalidate_lookups, search_lookup
 
 def manage_suppliers():
     st.title("🚚 Supplier Management")
@@ -16,7 +16,7 @@ def manage_suppliers():
             address = st.text_area("Address")
             if st.form_submit_button("Add Supplier"):
                 try:
-                    with sqlite3.connect(DATABASE) as conn:
+                    with connect(user_id) as conn:
                         cursor = conn.cursor()
                         cursor.execute('''
                         INSERT INTO suppliers (user_id, name, contact, email, address)
@@ -24,22 +24,23 @@ def manage_suppliers():
                         ''', (user_id, name, contact, email, address))
                         conn.commit()
                         log_history(user_id, "supplier", cursor.lastrowid, "create", f"Created supplier: {name}")
+                    invalidate_lookups(user_id, "suppliers")
                     st.success("Supplier added!")
                 except sqlite3.IntegrityError:
                     st.error("Supplier name already exists!")
 
     # Add Debt
     with st.expander("Add Supplier Debt"):
+        supplier_search = st.text_input("Search Supplier", key="supplier_debt_search")
         with st.form("new_supplier_debt_form"):
-            suppliers = pd.read_sql("SELECT id, name FROM suppliers WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
-            supplier_options = {row['name']: row['id'] for index, row in suppliers.iterrows()}
-            supplier_name = st.selectbox("Select Supplier", list(supplier_options.keys()))
+            matches = search_lookup(user_id, "suppliers", supplier_search)
+            selected_supplier = st.selectbox("Select Supplier", matches, format_func=lambda match: match[1])
             amount = st.number_input("Debt Amount", min_value=0.0)
             description = st.text_input("Description")
             due_date = st.date_input("Due Date")
-            if st.form_submit_button("Add Debt"):
-                supplier_id = supplier_options[supplier_name]
-                with sqlite3.connect(DATABASE) as conn:
+            if st.form_submit_button("Add Debt") and selected_supplier:
+                supplier_id, supplier_name, _ = selected_supplier
+                with connect(user_id) as conn:
                     cursor = conn.cursor()
                     cursor.execute('''
                     INSERT INTO supplier_debts (user_id, supplier_id, initial_amount, remaining_amount, description, due_date, status)
@@ -47,11 +48,20 @@ def manage_suppliers():
                     ''', (user_id, supplier_id, amount, amount, description, due_date))
                     conn.commit()
                     log_history(user_id, "supplier_debt", cursor.lastrowid, "create", f"Added debt for {supplier_name}: ₹{amount}")
+                invalidate_lookups(user_id, "supplier_debts")
                 st.success("Debt added!")
 
     # View Suppliers
     st.subheader("Supplier List")
-    suppliers = pd.read_sql("SELECT * FROM suppliers WHERE user_id=?", sqlite3.connect(DATABASE), params=(user_id,))
+    suppliers = query_df(user_id, f'''
+    SELECT s.id, s.name, s.contact, s.email, s.address, s.created_date, COALESCE(b.open_amount, 0) AS balance, COALESCE(o.overdue_amount, 0) AS overdue,
+           COALESCE(b.open_debts, 0) AS open_debts, b.last_payment_date
+    FROM suppliers s
+    LEFT JOIN counterparty_balances b
+        ON b.user_id = s.user_id AND b.counterparty_type = 'supplier' AND b.counterparty_id = s.id
+    LEFT JOIN ({overdue_amounts_sql("supplier")}) o ON o.counterparty_id = s.id
+    WHERE s.user_id=?
+    ''', (user_id, user_id))
     if not suppliers.empty:
         st.dataframe(suppliers)
     else:
@@ -59,8 +69,7 @@ def manage_suppliers():
     
     # Supplier History
     st.subheader("Supplier History")
-    supplier_history = pd.read_sql("SELECT * FROM history WHERE user_id=? AND entity_type IN ('supplier', 'supplier_debt') ORDER BY timestamp DESC", 
-                                 sqlite3.connect(DATABASE), params=(user_id,))
+    supplier_history = get_history(user_id, ['supplier', 'supplier_debt'])
     if not supplier_history.empty:
         st.dataframe(supplier_history)
         if st.button("Export Supplier History"):
@@ -0,0 +1,86 @@
+"""Multi-threaded stock contention test.
+
+Runs simulated cashiers as threads selling the same few products through
+database.record_sales against a throwaway database, then checks that stock never went
+negative, that every unit sold was taken off stock exactly once, and that no
+"database is locked" error reached a cashier. Prints sustained sales/s.
+
+    python stress_stock.py --cashiers 50 --duration 10
+"""
+import argparse
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import database
+
+def cashier(user_id, product_ids, deadline, stats, lock):
+    sold = short = failed = 0
+    while time.monotonic() < deadline:
+        items = [{'product_id': product_id, 'qty': random.randint(1, 3), 'price': 1.0}
+                 for product_id in random.sample(product_ids, random.randint(1, len(product_ids)))]
+        try:
+            result = database.record_sales(user_id, [items])[0]
+        except sqlite3.OperationalError:
+            failed += 1
+            continue
+        if result['ok']:
+            sold += sum(item['qty'] for item in items)
+        elif 'short' in result:
+            short += 1
+        else:
+            failed += 1
+    with lock:
+        stats['units'] += sold
+        stats['short'] += short
+        stats['failed'] += failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure stock-decrement throughput under contention")
+    parser.add_argument("--cashiers", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--products", type=int, default=3)
+    parser.add_argument("--stock", type=int, default=20000, help="Starting stock per product")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="retailpulse-stress-")
+    database.DATABASE = f"{workdir}/inventory.db"
+    database.SHARD_DIR = f"{workdir}/shards"
+    try:
+        database.init_db()
+        user_id = 1
+        with database.connect(user_id) as conn:
+            product_ids = [conn.execute("INSERT INTO products (user_id, name, quantity, unit_price) VALUES (?, ?, ?, 1.0)",
+                                        (user_id, f"Item {n}", args.stock)).lastrowid for n in range(args.products)]
+
+        stats = {'units': 0, 'short': 0, 'failed': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.duration
+        started = time.monotonic()
+        threads = [threading.Thread(target=cashier, args=(user_id, product_ids, deadline, stats, lock))
+                   for _ in range(args.cashiers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        with database.connect(user_id) as conn:
+            remaining = conn.execute("SELECT SUM(quantity), MIN(quantity) FROM products WHERE user_id = ?", (user_id,)).fetchone()
+            sales = conn.execute("SELECT COUNT(DISTINCT id), SUM(quantity_sold) FROM sales WHERE user_id = ?", (user_id,)).fetchone()
+        database.close_pools()
+        units_sold = sales[1] or 0
+        print(f"cashiers:        {args.cashiers}")
+        print(f"sale lines:      {sales[0]} ({sales[0] / elapsed:,.1f}/s)")
+        print(f"units sold:      {units_sold}, short sales rejected: {stats['short']}, failed: {stats['failed']}")
+        consistent = (remaining[0] + units_sold == args.stock * args.products and remaining[1] >= 0
+                      and units_sold == stats['units'] and stats['failed'] == 0)
+        print(f"stock consistent: {'yes' if consistent else 'NO'} (remaining {remaining[0]}, min {remaining[1]})")
+        raise SystemExit(0 if consistent else 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Background purge of deleted tenants.
+
+Deleting a user in Settings removes the users row and its API tokens at once and queues
+the tenant in tenant_purges. The purger then deletes the tenant's rows table by table in
+batches of PURGE_BATCH_ROWS, each batch its own short transaction, so other shops keep
+selling in between. Progress is saved after every batch and an interrupted purge simply
+continues where it stopped (`python manage.py purge-tenants`). Sale journal entries still
+pending for a deleted user are dropped by the applier instead of replayed. Freed pages are handed
+back to the filesystem with incremental_vacuum; database files created before
+auto_vacuum was enabled keep their free pages for reuse instead.
+"""
+import os
+import threading
+import time
+from database import DATABASE, SHARD_DIR, connect, connect_path, query_df, retry_on_lock
+
+PURGE_BATCH_ROWS = 2000       # rows deleted per transaction
+PURGE_PAUSE = 0.02            # seconds between batches so other writers get the lock
+VACUUM_PAGES_PER_STEP = 1024  # pages released per incremental_vacuum transaction
+
+# Dependent rows go before the rows they point at, so a half-finished purge leaves no dangling references
+PURGE_TABLES = [
+    "customer_debt_payments", "supplier_debt_payments", "customer_debts", "supplier_debts",
+    "applied_sales", "sales", "sales_daily", "demand_stats", "reorder_suggestions", "forecast_state",
+    "history", "history_counters", "products", "customers", "suppliers",
+    "counterparty_balances", "stock_totals",
+]
+
+_purger_lock = threading.Lock()
+_purger_thread = None
+
+def request_purge(user_id):
+    """Delete a user's account and API tokens and queue their data for purging; False if no such user."""
+    with connect() as conn:
+        row = conn.execute("SELECT username, shard FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM api_tokens WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        conn.execute("INSERT OR IGNORE INTO tenant_purges (user_id, username, shard) VALUES (?, ?, ?)",
+                     (user_id, row[0], row[1]))
+    return True
+
+def _tenant_files(user_id):
+    # The users row is gone, so the shard comes from the purge record. Rows copied by
+    # split_into_shards without --delete-source also linger in the central file.
+    with connect() as conn:
+        row = conn.execute("SELECT shard FROM tenant_purges WHERE user_id = ?", (user_id,)).fetchone()
+    paths = [os.path.join(SHARD_DIR, row[0])] if row and row[0] else []
+    return [path for path in paths + [DATABASE] if os.path.exists(path)]
+
+def _count_rows(user_id):
+    total = 0
+    for path in _tenant_files(user_id):
+        with connect_path(path) as conn:
+            for table in PURGE_TABLES:
+                total += conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = ?", (user_id,)).fetchone()[0]
+    return total
+
+@retry_on_lock
+def _delete_batch(path, table, user_id):
+    with connect_path(path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        return conn.execute(f'''
+        DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE user_id = ? LIMIT ?)
+        ''', (user_id, PURGE_BATCH_ROWS)).rowcount
+
+def _record_progress(user_id, deleted):
+    with connect() as conn:
+        conn.execute("UPDATE tenant_purges SET rows_deleted = rows_deleted + ? WHERE user_id = ?", (deleted, user_id))
+
+def incremental_vacuum(path):
+    """Release free pages of one database file in small steps; returns pages released."""
+    released = 0
+    while True:
+        with connect_path(path) as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return released
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return released
+            # executescript steps the pragma to completion; a single execute frees only one page
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            return released
+        released += free - remaining
+        time.sleep(PURGE_PAUSE)
+
+def purge_tenant(user_id, progress=None):
+    """Delete every row belonging to user_id in batches, then vacuum; returns rows deleted.
+
+    progress, if given, is called with (fraction, message) after each batch.
+    """
+    with connect() as conn:
+        row = conn.execute("SELECT rows_total, rows_deleted FROM tenant_purges WHERE user_id = ?", (user_id,)).fetchone()
+    done = row[1] if row else 0
+    total = row[0] if row and row[0] is not None else None
+    if total is None:
+        total = done + _count_rows(user_id)
+        with connect() as conn:
+            conn.execute("UPDATE tenant_purges SET rows_total = ? WHERE user_id = ?", (total, user_id))
+    deleted = 0
+    files = _tenant_files(user_id)
+    for path in files:
+        for table in PURGE_TABLES:
+            while True:
+                count = _delete_batch(path, table, user_id)
+                if count:
+                    deleted += count
+                    _record_progress(user_id, count)
+                    if progress:
+                        progress(min((done + deleted) / max(total, 1), 1.0), f"{os.path.basename(path)}: {table}")
+                if count < PURGE_BATCH_ROWS:
+                    break
+                time.sleep(PURGE_PAUSE)
+    for path in files:
+        if progress:
+            progress(1.0, f"Vacuuming {os.path.basename(path)}")
+        incremental_vacuum(path)
+    with connect() as conn:
+        conn.execute("UPDATE tenant_purges SET finished_at = CURRENT_TIMESTAMP WHERE user_id = ?", (user_id,))
+    return deleted
+
+def purge_pending(progress=None):
+    """Run every unfinished purge; returns {user_id: rows deleted}."""
+    with connect() as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT user_id FROM tenant_purges WHERE finished_at IS NULL ORDER BY requested_at")]
+    return {user_id: purge_tenant(user_id, progress) for user_id in user_ids}
+
+def start_purger():
+    """Work through queued purges in a background thread, once per process at a time."""
+    global _purger_thread
+    with _purger_lock:
+        if _purger_thread is None or not _purger_thread.is_alive():
+            _purger_thread = threading.Thread(target=purge_pending, name="tenant-purger", daemon=True)
+            _purger_thread.start()
+
+def purged_user_ids():
+    """Return the ids of deleted users, whose journaled sales must not be replayed."""
+    with connect() as conn:
+        return {row[0] for row in conn.execute("SELECT user_id FROM tenant_purges")}
+
+def purge_status():
+    """Return the purge queue, most recent first."""
+    return query_df(None, '''
+    SELECT user_id, username, requested_at, rows_deleted, rows_total, finished_at
+    FROM tenant_purges ORDER BY requested_at DESC
+    ''')